@@ -9,158 +9,385 @@ concerns."""
 # Standard libraries
 import argparse
 import datetime
+import fnmatch
+import hashlib
+import json
 import os
 import re
+import time
+from collections import namedtuple
 
 # Custom modules
 import pricer
+import pricestats
+import quarantine
+import scheduler
 
 
-# Hand entered list of symbols that should be ignored
-# These symbols find erroneous historical prices
-skip_symbols = ['1402', '1926', '1933', '1934', 'FRCMQ', 'KBS']
+DIGEST = 'batcher.digest'
+WATCH_CHECKPOINT = '.batcher.ckpt'
+POLL_INTERVAL = float(os.environ.get('BATCHER_POLL', 30))
+OUTCOMES = ['priced', 'failed', 'skipped']
 
+Record = namedtuple('Record', 'section date symbol line')
 
-def download_missing_prices(data, download_dir, date_start=0, symbol_start=8,
-                            pattern=None):
-    """Download historical prices based on Batch Status Report.
+
+class Layout(object):
+    """Where dates and symbols sit in the lines of a BSR section.
 
     Inputs:
-        data         - List of strings from BSR
-        download_dir - Destination for new price files
         date_start   - Column where date is located in lines (mm/dd/yy)
         symbol_start - Column where symbol is located in lines
-        patter       - Optional RegExp to identify lines that need parsing"""
-    date = None
-    symbols = set()
-
-    data.append('')
-    for line in data:
-        # If a pattern is provided, only use matching lines
-        if pattern is not None:
-            if not re.compile(pattern).match(line):
+        pattern      - Optional RegExp to identify lines that need parsing"""
+    def __init__(self, date_start=0, symbol_start=8, pattern=None):
+        self.date_start = date_start
+        self.symbol_start = symbol_start
+        self.regex = re.compile(pattern) if pattern is not None else None
+
+
+SECTIONS = frozenset([
+    'Missing Price Files',
+    'Unpriced Securities',
+    'Portfolios with Inception Date After Requested Date Range',
+    'No Inception Date for Portfolio',
+    'Cash Flows Exceeding  10.000% of Interval Beginning Value',
+    'No Market Value for Flow',
+    'Journal Entries',
+    'Trades to None',
+    'Inception Flows for Group Members',
+    'Unmanaged Asset Flows',
+    'Beginning Interval Value does not match the ending value of the previous interval - Portfolio Level',
+    'Beginning Interval Value does not match the ending value of the previous interval - Asset Class Level',
+    'Invalid Computed Intervals'])
+
+# Sections whose lines name a price to download
+LAYOUTS = {
+    # Missing price file or symbols not included in file
+    'Unpriced Securities': Layout(symbol_start=27),
+    # "Receipt of Securities" with no price info
+    'No Market Value for Flow': Layout(16, 26, '^Receipt|^Transfer.*')}
+
+
+def parse_date(text, this_year=None):
+    """Return the date of a BSR mm/dd/yy string."""
+    this_year = datetime.date.today().year % 100 if this_year is None else this_year
+    m, d, y = text.split('/')
+    year = int(y) % 100
+    if year <= this_year:
+        year += 2000
+    else:
+        year += 1900
+    return datetime.date(year, int(m), int(d))
+
+
+def parse_report(lines, layouts=LAYOUTS):
+    """Yield a Record for each issue line of a Batch Status Report.
+
+    Lines are read one at a time, nothing is kept past its record. A
+    section starts at its name and runs from the dashed line under its
+    column headers to the next blank line. Records of sections with a
+    layout carry the date and symbol of the price the line lacks, other
+    records have None for both."""
+    this_year = datetime.date.today().year % 100
+    dates = {}
+    section = layout = None
+    in_data = False
+    for line in lines:
+        line = line.strip()
+        if section is None:
+            if line in SECTIONS:
+                section = line
+                layout = layouts.get(section)
+            continue
+        if not in_data:
+            # Skip the blank line and column headers under the section name
+            in_data = line.startswith('-')
+            continue
+        if not line:
+            section = layout = None
+            in_data = False
+            continue
+
+        date = symbol = None
+        if layout is not None and (layout.regex is None or layout.regex.match(line)):
+            text = line[layout.date_start:layout.date_start + 8]
+            date = dates.get(text)
+            if date is None:
+                date = dates[text] = parse_date(text, this_year)
+            # Symbols with erroneous historical prices are pinned in quarantine
+            symbol = line[layout.symbol_start:layout.symbol_start + 16].strip() or None
+        yield Record(section, date, symbol, line)
+
+
+def download_plan(plan, download_dir, workers=None, carry_forward=None):
+    """Download every price in a plan at once, then write each price file once.
+
+    Symbols already in a date's fi{MMDDYY}.pri file are dropped first. The
+    rest are fetched in one batch, a lookup per symbol covering every date
+    it is missing on, and up to `workers` symbols at a time.
+
+    Returns a {(date, symbol): outcome} dict, where the outcome is 'priced',
+    'failed', or 'skipped' for closed markets, prices already there and
+    unpriced symbols that are pinned or quarantined."""
+    outcomes = {}
+    files = []
+    skipped = 0
+    for dt, symbols in sorted(plan.iteritems()):
+        price_dt = pricer.pricing_date(dt, carry_forward)
+        if price_dt is None:
+            print 'Market closed on', dt.strftime(pricer.DATE_FORMAT)
+            outcomes.update(((dt, symbol), 'skipped') for symbol in symbols)
+            continue
+        entries = pricer.read_quotes_file(pricer.price_filename(download_dir, dt))
+        wanted = sorted(symbol for symbol in symbols if symbol.upper() not in entries)
+        outcomes.update(((dt, symbol), 'skipped') for symbol in symbols
+                        if symbol.upper() in entries)
+        skipped += len(symbols) - len(wanted)
+        if wanted:
+            files.append((dt, price_dt, wanted))
+
+    price_dates = {}
+    for dt, price_dt, symbols in files:
+        for symbol in symbols:
+            price_dates.setdefault(symbol, set()).add(price_dt)
+    lookups = sorted(price_dates.iteritems())
+    count = sum(len(dates) for symbol, dates in lookups)
+    print 'Fetching {0} prices for {1} symbols into {2} files ({3} already there)'.format(
+        count, len(lookups), len(files), skipped)
+    if not lookups:
+        return outcomes
+
+    pricestats.get_stats().expect(count)
+    ranges = pricer.quote_lookups(lookups, workers)
+    prices = dict((symbol, symbol_prices)
+                  for (symbol, dates), symbol_prices in zip(lookups, ranges))
+
+    for dt, price_dt, symbols in files:
+        symbol_prices = [prices[symbol].get(price_dt, -1) for symbol in symbols]
+        for symbol, price in zip(symbols, symbol_prices):
+            if price > 0:
+                outcomes[dt, symbol] = 'priced'
                 continue
+            state = quarantine.state(symbol)
+            if state is not None:
+                print 'Skipped {0} on {1}: {2}'.format(
+                    symbol, dt.strftime(pricer.DATE_FORMAT), state)
+                outcomes[dt, symbol] = 'skipped'
+            else:
+                outcomes[dt, symbol] = 'failed'
+        quotes = pricer.build_quotes(symbols, symbol_prices)
+        filename = pricer.price_filename(download_dir, dt)
+        print 'File: ' + filename
+        pricer.write_quotes_file(quotes, filename, dt.strftime(pricer.PC_FORMAT))
+
+    return outcomes
+
+
+def issue_key(record):
+    """Return a short digest of an issue line, the same in every report."""
+    return hashlib.sha1(record.section + '\0' + record.line).hexdigest()[:16]
+
+
+def load_digest(download_dir):
+    """Return the {issue key: outcome} dict of the last report handled."""
+    filename = os.path.join(download_dir, DIGEST)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
 
-        new_date = line[date_start:date_start + 8]
-        if new_date != date:
-            if date:
-                m, d, y = date.split('/')
-                year = int(y) % 100
-                if year <= datetime.date.today().year % 100:
-                    year += 2000
-                else:
-                    year += 1900
-                month = int(m)
-                day = int(d)
-
-                dt = datetime.date(year, month, day)
-                quotes = pricer.get_quotes(symbols, dt)
-                date_str = ''.join(date.split('/'))
-                filename = os.path.join(download_dir, 'fi{0}.pri'.format(date_str))
-                pricer.write_quotes_file(quotes, filename, date_str)
-
-            date = new_date
-            symbols = set()
-
-        symbol = line[symbol_start:symbol_start + 16].strip()
-        if symbol not in skip_symbols:
-            symbols.add(symbol)
-
-
-def noflow(data, download_dir):
-    """'No Market Value for Flow' handler
-
-    "Receipt of Securities" with no price info get downloaded."""
-    download_missing_prices(data, download_dir, 16, 26, '^Receipt|^Transfer.*')
-
-
-def unpriced(data, download_dir=None):
-    """'Unprices Securities' handler
-
-    Missing price file or symbols not included in file get downloaded."""
-    download_missing_prices(data, download_dir, symbol_start=27)
-
-
-def main(filename, download_dir=None):
-    # Create a function lookup dict to handle sections of BSR
-    sections = ['Missing Price Files',
-                'Unpriced Securities',
-                'Portfolios with Inception Date After Requested Date Range',
-                'No Inception Date for Portfolio',
-                'Cash Flows Exceeding  10.000% of Interval Beginning Value',
-                'No Market Value for Flow',
-                'Journal Entries',
-                'Trades to None',
-                'Inception Flows for Group Members',
-                'Unmanaged Asset Flows',
-                'Beginning Interval Value does not match the ending value of the previous interval - Portfolio Level',
-                'Beginning Interval Value does not match the ending value of the previous interval - Asset Class Level',
-                'Invalid Computed Intervals']
-    functions = [None,
-                 unpriced,
-                 None,
-                 None,
-                 None,
-                 noflow,
-                 None,
-                 None,
-                 None,
-                 None,
-                 None,
-                 None,
-                 None]
-    handlers = dict(zip(sections, functions))
 
+def save_digest(download_dir, digest):
+    """Replace the digest with the outcomes of this report's issues."""
+    filename = os.path.join(download_dir, DIGEST)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(digest, f, separators=(',', ':'))
+    pricer.replace_file(filename + '.tmp', filename)
+
+
+def report_changes(previous, digest, retried, outcomes):
+    """Print how this report's issues differ from the last one's."""
+    new = sum(1 for key in digest if key not in previous)
+    repeated = len(digest) - new - retried
+    resolved = sum(1 for key in previous if key not in digest)
+    print 'Issues: {0} new, {1} failed before and retried, {2} already handled, ' \
+          '{3} gone since the last report'.format(new, retried, repeated, resolved)
+    counts = dict((outcome, 0) for outcome in OUTCOMES)
+    for outcome in outcomes.itervalues():
+        counts[outcome] += 1
+    print 'This run: {priced} priced, {failed} failed, {skipped} skipped'.format(**counts)
+
+
+def main(filename, download_dir=None, workers=None, carry_forward=None,
+         full=False):
     # Ensure download directory
     if not download_dir:
         download_dir = os.environ.get('PRICE_DD',
                                       os.path.join('..', 'supplemental-prices'))
 
-    section = None
+    # Issues handled for an earlier report are only retried if they failed
+    previous = {} if full else load_digest(download_dir)
+    digest = {}
+    issues = {}
+    retried = set()
 
     # Process BSR line by line, and section by section
+    section = None
+    count = 0
+    plan = {}
     with open(filename, 'r') as f:
-        while f:
-            # Read and clean 1 line at a time
-            line = f.readline()
-            if line == '':
-                break
-            else:
-                line = line.strip()
+        for record in parse_report(f):
+            if record.section != section:
+                if section:
+                    print '\t', count, 'lines'
+                    print 'Exiting...\n'
+                section = record.section
+                count = 0
+                print 'Entering section:', section
+            count += 1
+            if not record.symbol:
+                continue
+            key = issue_key(record)
+            outcome = previous.get(key)
+            if outcome in ('priced', 'skipped'):
+                digest[key] = outcome
+                continue
+            if outcome == 'failed':
+                retried.add(key)
+            issues[key] = (record.date, record.symbol)
+            plan.setdefault(record.date, set()).add(record.symbol)
+    if section:
+        print '\t', count, 'lines'
+        print 'Exiting...\n'
 
-            # Look for section headers and collect data
-            if line in sections:
-                section = line
-                print 'Entering section:', line
-                f.readline()  # Eliminate a blank line
-                header = f.readline().strip()
-                while header[0] != '-':
-                    print '\t', header
-                    header = f.readline().strip()
-
-                # Section header found, collect data
-                data = []
-                while line != '':
-                    line = f.readline().strip()
-                    if line:
-                        data.append(line)
-
-            # Handle the end of a section
-            if section and line == '':
-                print '\t', len(data), 'lines'
-                func = handlers[section]
-                if func:
-                    func(data, download_dir)
-                print 'Exiting...\n'
-                section = None
+    # Sections only plan the work, the prices are fetched together
+    outcomes = download_plan(plan, download_dir, workers, carry_forward)
+    for key, pair in issues.iteritems():
+        digest[key] = outcomes.get(pair, 'failed')
+    report_changes(previous, digest, len(retried), outcomes)
+    if os.path.exists(download_dir):
+        save_digest(download_dir, digest)
+    pricer.finish_run()
+
+
+def load_watch(checkpoint):
+    """Return the watch state: reports done and the one in progress."""
+    if not os.path.exists(checkpoint):
+        return {'done': {}, 'current': None}
+    with open(checkpoint, 'r') as f:
+        return json.load(f)
+
+
+def save_watch(checkpoint, state):
+    with open(checkpoint + '.tmp', 'w') as f:
+        json.dump(state, f)
+    pricer.replace_file(checkpoint + '.tmp', checkpoint)
+
+
+def signature(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+
+def watch(directory, download_dir=None, workers=None, carry_forward=None,
+          match='*.txt', interval=POLL_INTERVAL, pause=0):
+    """Handle each report that lands in directory once, polling forever.
+
+    A report is picked up once it stops changing between two polls, and
+    again only if it is replaced. A report that fails to be handled is not
+    marked done; it is tried again once it changes, or after a restart.
+    Reports are handled one at a time, with
+    `pause` seconds between them, on the rate limits of the scheduler.
+    The report in progress is kept in a checkpoint, so a restart handles
+    it first; its price files already written and prices already cached
+    are not fetched again."""
+    checkpoint = os.path.join(directory, WATCH_CHECKPOINT)
+    state = load_watch(checkpoint)
+    seen = {}
+    failed = {}
+    print 'Watching {0} for {1}, every {2:g} s'.format(directory, match, interval)
+
+    while True:
+        ready = []
+        if state['current'] and os.path.exists(os.path.join(directory, state['current'])):
+            print 'Resuming', state['current']
+            ready.append(state['current'])
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not fnmatch.fnmatch(name, match) or not os.path.isfile(path):
+                continue
+            sig = signature(path)
+            if sig in (state['done'].get(name), failed.get(name)) or name in ready:
+                continue
+            # Wait for reports still being written to settle
+            if seen.get(name) == sig:
+                ready.append(name)
+            seen[name] = sig
+
+        for name in ready:
+            path = os.path.join(directory, name)
+            state['current'] = name
+            save_watch(checkpoint, state)
+            print 'Handling', path
+            # A host that failed on the last report gets another chance
+            if scheduler.get_scheduler().tripped():
+                scheduler.get_scheduler().reset()
+            # Time the report, not the polling before it
+            pricestats.reset()
+            try:
+                main(path, download_dir, workers, carry_forward)
+                outcome = state['done']
+            except Exception as e:
+                print 'Failed to handle {0}: {1}'.format(path, e)
+                outcome = failed
+            failed.pop(name, None)
+            try:
+                outcome[name] = signature(path)
+            except OSError:
+                # Gone or being renamed, it is seen afresh if it comes back
+                pass
+            state['current'] = None
+            save_watch(checkpoint, state)
+            seen.pop(name, None)
+            time.sleep(pause)
+
+        time.sleep(interval)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('filename',
+    parser.add_argument('filename', nargs='?',
                         help='batch status report stored as a text file')
     parser.add_argument('-d', '--download-directory', nargs='?',
                         help='destination for new price files')
+    parser.add_argument('-w', '--workers', type=int, default=pricer.WORKERS,
+                        help='number of symbols to download at once')
+    parser.add_argument('-k', '--carry-forward', action='store_true',
+                        default=pricer.CARRY_FORWARD,
+                        help='write the previous close on market holidays')
+    parser.add_argument('--full', action='store_true', default=False,
+                        help='handle every issue, even those handled before')
+    parser.add_argument('-l', '--rate', type=float, default=scheduler.RATE,
+                        help='most requests per second to the quote server')
+    parser.add_argument('--watch', metavar='DIR',
+                        help='handle each new report saved in DIR, until stopped')
+    parser.add_argument('--match', default='*.txt',
+                        help='file name pattern of reports to watch for')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between looks for new reports')
+    parser.add_argument('--pause', type=float, default=0,
+                        help='seconds to rest between reports')
     args = parser.parse_args()
+    if (args.filename is None) == (args.watch is None):
+        parser.error('give either a report or --watch DIR')
 
-    main(args.filename, args.download_directory)
+    scheduler.configure(rate=args.rate)
+    if args.watch:
+        try:
+            watch(args.watch, args.download_directory, args.workers,
+                  args.carry_forward, args.match, args.interval, args.pause)
+        except KeyboardInterrupt:
+            pass
+    else:
+        main(args.filename, args.download_directory, args.workers,
+             args.carry_forward, args.full)
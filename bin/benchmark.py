@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+
+'''Measure the speed of price downloads and file conversions offline.
+
+Each benchmark runs against saved or synthetic data, never the network.
+Download benchmarks start a stand-in quote server (see standin.py) and
+append their results to BENCHMARK_RESULTS, comparing each run with the
+last one of the same benchmark and settings.'''
+
+# Standard libraries
+import argparse
+import datetime
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+from contextlib import contextmanager
+from StringIO import StringIO
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Custom modules
+import batcher
+import fidoconvert
+import httppool
+import layouts
+import priced
+import pricer
+import pricestats
+import quotecache
+import scheduler
+import standin
+import tradingcal
+from standin import synthetic_page
+
+
+RESULTS_FILE = os.environ.get('BENCHMARK_RESULTS', 'benchmark.jsonl')
+SETTINGS = ['benchmark', 'symbols', 'dates', 'workers', 'connections',
+            'latency', 'error_rate', 'page_size', 'pages']
+
+# The output templates fidoconvert's converters used before layouts.py,
+# copied verbatim, so bench_convert can check the layouts still match them
+LEGACY_TEMPLATES = {
+    'trn': ('{acct_num:14}{trans_code:2} {trade_date:6} '
+            '{sec_type_code:2} {symbol:9} {net_amount:>15.02f} {source:7} '
+            '{quantity:>15.05f} {broker:7} {broker_fee:>9.02f} {tk_code:4} '
+            '{tkc_desc:21} {other_fee:>16.04f} {SEC_fee:>16.04f} '
+            '{option_symbol:30} {settle_date:6} {order_action:20}'),
+    'pos': ('{acct_num:14} {acct_type:1d} {cusip:9} {symbol:9} '
+            '{trade_date_quantity:>15.05f} {settle_date_quantity:>15.05f} '
+            '{close_price:15} {description:40} {date_str:8} '
+            '{factor:17} {face_amount:18} {clean_price:18} {factored:1} '
+            '{sec_type:2} {option_symbol:30} {rep1:3}{rep2:3}'),
+    'pri': '{symbol:58}{price:>15.07f}{pc_datestr}',
+    'sec': '{sec_type}{symbol:9}{desc:40}{cusip:>9}  0.00',
+    'nam': '{acct_num11:11}{tacct_num:10} {full_name}',
+    'acc': ('{acct_num:14} {tax_id:11}     {full_name:20}     '
+            '{tacct_num:10}     {acct_type:24}      {date_str:12} '
+            '{cost_basis:4} {corp_indicator:1}')}
+
+
+def load_pages(patterns):
+    '''Return (name, content) pairs for saved pages, or a synthetic page.'''
+    pages = []
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)):
+            with open(filename, 'rb') as f:
+                pages.append((filename, f.read()))
+    return pages or [('synthetic', synthetic_page())]
+
+
+def time_per_call(func, repeat):
+    '''Return the best average seconds per call of func over 3 trials.'''
+    return min(timeit.repeat(func, number=repeat, repeat=3)) / repeat
+
+
+def bench_parse(args):
+    '''Closing price extraction: streaming scan vs full PriceParser feed.'''
+    line = '{0:32} {1:>10} {2:>10} {3:>8} {4:>10} {5:>10}'
+    print line.format('page', 'full us', 'scan us', 'speedup',
+                      'page bytes', 'scanned')
+
+    for name, content in load_pages(args.pages):
+        def full():
+            parser = pricer.PriceParser()
+            parser.feed(content)
+            return parser.price
+
+        def scan():
+            return pricer.extract_closing_price(StringIO(content))
+
+        price, scanned = scan()
+        if price != full():
+            print '{0}: scan found {1}, parser found {2}'.format(name, price, full())
+        full_time = time_per_call(full, args.repeat)
+        scan_time = time_per_call(scan, args.repeat)
+        print line.format(name[-32:], '{0:.1f}'.format(full_time * 1e6),
+                          '{0:.1f}'.format(scan_time * 1e6),
+                          '{0:.1f}x'.format(full_time / scan_time),
+                          len(content), len(scanned))
+
+    return 0
+
+
+def synthetic_symbols(count):
+    '''Return count made up symbols the stand-in server prices.'''
+    return ['S{0:04d}'.format(n) for n in range(count)]
+
+
+def synthetic_dates(count, end=datetime.date(2015, 3, 31)):
+    '''Return the last count trading days up to end, oldest first.'''
+    dates = []
+    dt = end
+    while len(dates) < count:
+        if tradingcal.is_trading_day(dt):
+            dates.append(dt)
+        dt -= datetime.timedelta(1)
+    return dates[::-1]
+
+
+def peak_memory():
+    '''Return the peak resident memory of this process in KB, if known.'''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@contextmanager
+def quiet():
+    '''Hide the price lines pricer prints while a benchmark runs.'''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def run_download(args, func):
+    '''Time func against a fresh stand-in server, return the measurements.
+
+    Only the web is asked for prices, nothing is cached, requests are not
+    rate limited, the circuit breaker never opens and the price daemon is
+    not used. func returns the number of quotes it asked for.'''
+    pages = [content for name, content in load_pages(args.pages)] if args.pages else None
+    server = standin.start(latency=args.latency, error_rate=args.error_rate,
+                           page_size=args.page_size, pages=pages)
+    pricer.BASE_URL = server.url
+    quotecache.CACHE_FILE = ''
+    priced.ADDRESS = ''
+    pricer.configure_providers('web')
+    httppool.configure(args.connections, args.timeout)
+    scheduler.configure(args.retries, 0, 0)
+    stats = pricestats.reset(False)
+
+    start = time.time()
+    try:
+        with quiet():
+            quotes = func()
+        seconds = time.time() - start
+    finally:
+        httppool.get_pool().close()
+        server.shutdown()
+        server.server_close()
+
+    latencies = sorted(latency for host_latencies in stats.latencies.itervalues()
+                       for latency in host_latencies)
+    return {'benchmark': args.benchmark,
+            'when': datetime.datetime.now().isoformat(),
+            'symbols': args.symbols,
+            'dates': args.dates,
+            'workers': args.workers,
+            'connections': args.connections,
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'page_size': args.page_size,
+            'pages': len(pages or []),
+            'quotes': quotes,
+            'seconds': round(seconds, 3),
+            'quotes_per_sec': round(quotes / seconds, 2) if seconds else 0.0,
+            'requests': server.counters['requests'],
+            'errors': server.counters['errors'],
+            'p50_ms': round(1000 * pricestats.percentile(latencies, 0.5), 1),
+            'p99_ms': round(1000 * pricestats.percentile(latencies, 0.99), 1),
+            'peak_rss_kb': peak_memory()}
+
+
+def load_results(filename):
+    '''Return the results saved in a JSON lines file, oldest first.'''
+    results = []
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    results.append(json.loads(line))
+    return results
+
+
+def save_result(result, filename):
+    '''Append result to filename, return the last one with the same settings.'''
+    key = [result[name] for name in SETTINGS]
+    previous = None
+    for earlier in load_results(filename):
+        if [earlier.get(name) for name in SETTINGS] == key:
+            previous = earlier
+    with open(filename, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+    return previous
+
+
+def report_result(result, previous):
+    '''Print a result, and how it changed since the previous run.'''
+    line = '{0:16}{1:>12}{2}'
+    for name, unit in [('quotes_per_sec', ''), ('p50_ms', ' ms'),
+                       ('p99_ms', ' ms'), ('peak_rss_kb', ' KB')]:
+        value = result[name]
+        change = ''
+        if previous and previous.get(name) and value is not None:
+            change = '  (was {0}{1}, {2:+.1f}%)'.format(
+                previous[name], unit, 100.0 * (value - previous[name]) / previous[name])
+        print line.format(name, '{0}{1}'.format(value, unit), change)
+    print line.format('quotes', result['quotes'], '')
+    print line.format('requests', result['requests'],
+                      '  ({0} errors)'.format(result['errors']))
+
+
+def bench_download(args, func):
+    '''Run a download benchmark, save and print its result.'''
+    print '{0}: {1} symbols x {2} dates, {3} workers, {4}s latency, {5:.0%} errors'.format(
+        args.benchmark, args.symbols, args.dates, args.workers, args.latency,
+        args.error_rate)
+    result = run_download(args, func)
+    previous = save_result(result, args.results)
+    report_result(result, previous)
+    return 0
+
+
+def bench_quote(args):
+    '''get_quote, one symbol and date at a time.'''
+    symbols = synthetic_symbols(args.symbols)
+    dates = synthetic_dates(args.dates)
+
+    def quote_all():
+        for dt in dates:
+            for symbol in symbols:
+                pricer.get_quote(symbol, dt)
+        return len(symbols) * len(dates)
+
+    return bench_download(args, quote_all)
+
+
+def bench_quotes(args):
+    '''get_quotes, every symbol at once, one date at a time.'''
+    symbols = synthetic_symbols(args.symbols)
+    dates = synthetic_dates(args.dates)
+
+    def quote_all():
+        for dt in dates:
+            pricer.get_quotes(symbols, dt, args.workers)
+        return len(symbols) * len(dates)
+
+    return bench_download(args, quote_all)
+
+
+def bench_download_date(args):
+    '''download_date into a scratch directory, one date at a time.'''
+    symbols = synthetic_symbols(args.symbols)
+    dates = synthetic_dates(args.dates)
+    download_dir = tempfile.mkdtemp(prefix='benchmark')
+
+    def download_all():
+        for dt in dates:
+            pricer.download_date(symbols, dt, download_dir, workers=args.workers,
+                                 report=False)
+        return len(symbols) * len(dates)
+
+    try:
+        return bench_download(args, download_all)
+    finally:
+        shutil.rmtree(download_dir)
+
+
+def synthetic_report(f, lines):
+    '''Write a Batch Status Report of about `lines` issue lines to f.'''
+    symbols = synthetic_symbols(500)
+    dates = [dt.strftime('%m/%d/%y') for dt in synthetic_dates(60)]
+    half = lines // 2
+    f.write('Batch Status Report\n\nUnpriced Securities\n\n'
+            'Date       Portfolio       Symbol\n{0}\n'.format('-' * 60))
+    for n in xrange(half):
+        f.write('{0:11}{1:16}{2}\n'.format(dates[n % len(dates)], 'P{0:05d}'.format(n % 997),
+                                           symbols[n % len(symbols)]))
+    f.write('\nNo Market Value for Flow\n\n'
+            'Type            Date      Symbol\n{0}\n'.format('-' * 60))
+    kinds = ['Receipt', 'Transfer in', 'Dividend']
+    for n in xrange(lines - half):
+        f.write('{0:16}{1:10}{2}\n'.format(kinds[n % len(kinds)], dates[n % len(dates)],
+                                           symbols[n % len(symbols)]))
+    f.write('\n')
+
+
+def bench_bsr(args):
+    '''Batch Status Report parsing, streamed from a synthetic report.'''
+    f = tempfile.TemporaryFile()
+    synthetic_report(f, args.lines)
+    before = peak_memory()
+
+    def parse():
+        f.seek(0)
+        plan = {}
+        for record in batcher.parse_report(f):
+            if record.symbol:
+                plan.setdefault(record.date, set()).add(record.symbol)
+        return plan
+
+    seconds = min(timeit.repeat(parse, number=1, repeat=3))
+    plan = parse()
+    f.close()
+    print '{0} lines in {1:.3f} s, {2:,.0f} lines/s'.format(args.lines, seconds,
+                                                          args.lines / seconds)
+    print '{0} prices planned on {1} dates'.format(
+        sum(len(symbols) for symbols in plan.itervalues()), len(plan))
+    if before is not None:
+        print 'peak memory {0} KB ({1:+} KB while parsing)'.format(
+            peak_memory(), peak_memory() - before)
+
+    return 0
+
+
+def sample_values(layout):
+    '''Return made up values for each field of layout, in order.'''
+    values = []
+    for field in layout.fields:
+        if field.spec.endswith('f'):
+            values.append(1234.5678)
+        elif field.spec == 'd':
+            values.append(1)
+        else:
+            values.append('x' * ((field.width or 8) // 2))
+    return values
+
+
+def synthetic_transactions(f, rows):
+    '''Write a TIAA-CREF transaction export of `rows` rows to f.'''
+    codes = ['BUY', 'SELL', 'DIV', 'INT', 'DEP', 'WITH', 'MFEE']
+    for n in xrange(rows):
+        f.write('TC,,AAAAAAAA BBBBBB {0:06d},{1},N,QCSTRX,MF,03042015,'
+                '{2:.3f},{3:.2f},,,,,,,,\r\n'.format(n % 997, codes[n % len(codes)],
+                                                 n % 100 + 0.125, n % 1000 + 0.5))
+
+
+def bench_convert(args):
+    '''Record formatting per layout, and TIAA-CREF .TRN conversion per row.
+
+    Each layout is checked against the converters' old template first, and
+    1 is returned if any record comes out different.'''
+    status = 0
+    line = '{0:8} {1:>12} {2:>12} {3:>8}'
+    print line.format('layout', 'legacy us', 'compiled us', 'speedup')
+    for name, layout in sorted(layouts.LAYOUTS.iteritems()):
+        values = sample_values(layout)
+        fields = dict(zip(layout.names, values))
+        legacy = LEGACY_TEMPLATES[name]
+        if legacy.format(**fields) != layout.format(*values):
+            print '{0}: layout differs from the legacy template'.format(name)
+            status = 1
+        named_time = time_per_call(lambda: legacy.format(**fields), args.repeat)
+        compiled_time = time_per_call(lambda: layout.format(*values), args.repeat)
+        print line.format(name, '{0:.2f}'.format(named_time * 1e6),
+                          '{0:.2f}'.format(compiled_time * 1e6),
+                          '{0:.1f}x'.format(named_time / compiled_time))
+
+    directory = tempfile.mkdtemp(prefix='benchmark')
+    infile = os.path.join(directory, 'ad150304.trn')
+    with open(infile, 'w') as f:
+        synthetic_transactions(f, args.lines)
+    outfile = fidoconvert.get_fidelity_path_from_tiaa_cref(infile)
+    call = fidoconvert.call
+    fidoconvert.call = lambda args: 0  # No chown of scratch files
+
+    def convert():
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        fidoconvert.convert_tiaa_cref_trn_file(infile)
+
+    try:
+        with quiet():
+            seconds = min(timeit.repeat(convert, number=1, repeat=3))
+    finally:
+        fidoconvert.call = call
+        shutil.rmtree(directory)
+    print '{0} rows in {1:.3f} s, {2:,.0f} rows/s'.format(args.lines, seconds,
+                                                        args.lines / seconds)
+
+    return status
+
+
+def bench_fixed(args):
+    '''Fixed-width field extraction: repeated slicing vs FixedReader.'''
+    widths = [14, 2, 1, 6, 1, 2, 1, 9, 1, 15, 1, 7, 1, 15, 1, 7, 1, 9, 1, 4, 1, 21]
+    record = ''.join(chr(ord('a') + n % 26) * width for n, width in enumerate(widths))
+    lines = [record + '\r\n'] * args.lines
+    reader = fidoconvert.FixedReader(widths)
+
+    def sliced():
+        for line in lines:
+            values = []
+            for width in widths:
+                values.append(line[:width])
+                line = line[width:]
+
+    def unpacked():
+        for values in reader.read(lines):
+            pass
+
+    sliced_time = min(timeit.repeat(sliced, number=1, repeat=3))
+    unpacked_time = min(timeit.repeat(unpacked, number=1, repeat=3))
+    print '{0} lines of {1} fields'.format(args.lines, len(widths))
+    print 'sliced    {0:,.0f} lines/s'.format(args.lines / sliced_time)
+    print 'unpacked  {0:,.0f} lines/s ({1:.1f}x)'.format(args.lines / unpacked_time,
+                                                        sliced_time / unpacked_time)
+
+    return 0
+
+
+BENCHMARKS = {'parse': bench_parse,
+              'bsr': bench_bsr,
+              'convert': bench_convert,
+              'fixed': bench_fixed,
+              'quote': bench_quote,
+              'quotes': bench_quotes,
+              'download': bench_download_date}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS),
+                        help='which benchmark to run')
+    parser.add_argument('pages', nargs='*',
+                        help='saved quote pages (glob patterns) to parse or serve')
+    parser.add_argument('-r', '--repeat', type=int, default=200,
+                        help='calls per timing trial')
+    parser.add_argument('-n', '--symbols', type=int, default=50,
+                        help='number of synthetic symbols to download')
+    parser.add_argument('-D', '--dates', type=int, default=5,
+                        help='number of trading days to download')
+    parser.add_argument('-w', '--workers', type=int, default=pricer.WORKERS,
+                        help='number of symbols to download at once')
+    parser.add_argument('-c', '--connections', type=int,
+                        default=httppool.MAX_CONNECTIONS,
+                        help='most connections open to the stand-in server')
+    parser.add_argument('-t', '--timeout', type=float, default=httppool.TIMEOUT,
+                        help='seconds to wait on the stand-in server')
+    parser.add_argument('--retries', type=int, default=scheduler.RETRIES,
+                        help='times to retry a failed request')
+    parser.add_argument('-L', '--latency', type=float, default=0.0,
+                        help='average seconds the stand-in server waits')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 503')
+    parser.add_argument('-s', '--page-size', type=int, default=60000,
+                        help='approximate bytes per synthetic page')
+    parser.add_argument('--lines', type=int, default=200000,
+                        help='issue lines in the synthetic report for bsr, '
+                             'or rows or lines to convert')
+    parser.add_argument('--results', default=RESULTS_FILE,
+                        help='JSON lines file results are appended to')
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
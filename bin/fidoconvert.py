@@ -1,69 +1,314 @@
 #!/usr/bin/env python
 
 import os
+import sys
 import datetime
 import glob
 import argparse
 import csv
+import hashlib
+import json
+import struct
+import traceback
+from collections import OrderedDict
+from multiprocessing import Pool
+from StringIO import StringIO
 from subprocess import call
 
+from layouts import ACC, NAM, POS, PRI, SEC, TRN
+
 PC_DATE_FORMAT = '%m%d%y'
+BUFFER_SIZE = 64 * 1024
+JOBS = int(os.environ.get('FIDOCONVERT_JOBS', 1))
+MANIFEST = 'fidoconvert.manifest'
+
+# TIAA-CREF transaction types: Fidelity transaction code
+TIAA_CREF_TRANS_CODES = {'BUY': 'by',
+                         'SECBUY': 'dv',
+                         'DEP': 'dp',
+                         'DIV': 'dv',
+                         'INT': 'in',
+                         'SELL': 'sl',
+                         'WITH': 'wd',
+                         'MFEE': 'wd'}
+
+# Fidelity transaction code: (ticket code, ticket description)
+TIAA_CREF_TK_CODES = {'by': ('BOT', 'BOUGHT'),
+                      'dp': ('REC', 'RECEIVED FROM YOU'),
+                      'dv': ('DIV', 'DIVIDEND'),
+                      'in': ('INT', 'INTEREST'),
+                      'sl': ('SLD', 'SOLD'),
+                      'wd': ('DEL', 'DELIVERED TO YOU')}
+
+# Schwab actions: (transaction code, ticket code, ticket description, source)
+SCHWAB_ACTIONS = {'Buy': ('by', 'BOT', 'BOUGHT', 'cash'),
+                  'Sell': ('sl', 'SLD', 'SOLD', 'cash'),
+                  'CD Deposit Adj': ('cd', 'RDM', 'REDEEMED', 'cash'),
+                  'CD Deposit Funds': ('skip', '', '', ''),
+                  'Security Transfer': ('st', 'TFR', 'TRANSFERRED', 'cash'),
+                  'Principal Payment': ('rc', 'PRN', 'PRINCIPAL PAYMENT', 'cash'),
+                  'Bond Interest': ('in', 'INT', 'INTEREST', 'cash'),
+                  'Bank Interest': ('in', 'INT', 'INTEREST', 'cash'),
+                  'CD Interest': ('in', 'INT', 'INTEREST', 'cash'),
+                  'Tax Withholding': ('pn', 'PN', 'TAX W/H', 'cash'),
+                  'Stock Split': ('by', 'DST', 'DISTRIBUTION', 'cash'),
+                  'Advisor Fee': ('wd', 'ADF', 'ADVISOR FEE', 'client'),
+                  'Funds Paid': ('wd', 'DEL', 'DELIVERED TO YOU', 'client'),
+                  'Auto S1 Debit': ('wd', 'DEL', 'DELIVERED TO YOU', 'client'),
+                  'Visa Purchase': ('wd', 'DEL', 'DELIVERED TO YOU', 'client'),
+                  'ATM Withdrawal': ('wd', 'DEL', 'DELIVERED TO YOU', 'client'),
+                  'Funds Received': ('dp', 'REC', 'RECEIVED FROM YOU', 'client'),
+                  'Auto S1 Credit': ('dp', 'REC', 'RECEIVED FROM YOU', 'client'),
+                  'Schwab ATM Rebate': ('dp', 'REC', 'RECEIVED FROM YOU', 'client'),
+                  'Pr Yr Cash Div': ('dv', 'DIV', 'DIVIDEND', 'cash'),
+                  'Qualified Dividend': ('dv', 'DIV', 'DIVIDEND', 'cash'),
+                  'Reinvest Dividend': ('rdv', 'DIV', 'DIVIDEND', 'dvwash'),
+                  'Reinvest Shares': ('rby', 'RIN', 'REINVESTMENT', 'dvsplit'),
+                  'Cash Dividend': ('dv', 'DIV', 'DIVIDEND', 'cash')}
+
+# Fidelity history actions: Fidelity transaction code
+FIDELITY_TRANS_CODES = {'Buy': 'by',
+                        'Sell': 'sl',
+                        'Withdrawal': 'wd',
+                        'Deposit': 'dp',
+                        'Fee': 'dp',
+                        'Interest': 'in',
+                        'Dividend': 'dv'}
+
+# PlanDestination activities: ticket codes, not used yet
+PLANDESTINATION_ACTIVITIES = {'ASSET ALLOCATION': 'BOT|SLD',
+                              'Corporate Fund Merger Adj': '',
+                              'EMPLOYEE PRE-TAX CONTRIBUTION': '',
+                              'EMPLOYER MATCHING CONTRIBUTION': '',
+                              'INCOME ADJUSTMENT': '',
+                              'PURCHASE DUE TO FUND SWAP': '',
+                              'PURCHASE DUE TO FUND TRANSFER': '',
+                              'REINVESTED DIVIDEND': 'DIV->RIN',
+                              'SALE DUE TO FUND SWAP': '',
+                              'SALE DUE TO FUND TRANSFER': '',
+                              'TRANSFER TO PERMANENT INVESTMENT': 'REC'}
+
+# Ticket code: ticket description
+TK_DESCRIPTIONS = {'BOT': 'BOUGHT',
+                   'BUY': 'BOUGHT',
+                   'SLD': 'SOLD',
+                   'SEL': 'SOLD',
+                   'JNL': 'JOURNAL',
+                   'ADF': 'ADVISOR FEE',
+                   'INT': 'INTEREST',
+                   'DST': 'DISTRIBUTION',
+                   'RDM': 'REDEEMED',
+                   'PDP': 'NORMAL DISTR PARTIAL',
+                   'ETT': 'MONEY LINE PAID EFT',
+                   'FPN': 'FED TAX W/H',
+                   'SPN': 'STATE TAX W/H',
+                   'RIN': 'REINVESTMENT',
+                   'DIV': 'DIVIDEND'}
+
+MONTHS = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04',
+          'May': '05', 'Jun': '06', 'Jul': '07', 'Aug': '08',
+          'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
+
+
+def replace_file(src, dst):
+    '''Rename src over dst, even where rename won't overwrite.'''
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+class RecordWriter(object):
+    '''Write records joined by separator, opening outfile on the first one.
+
+    In 'w' mode records go to a temporary file that replaces outfile on
+    commit(). In 'a' mode they are appended, and discard() cuts outfile
+    back to its old length, so a failed conversion leaves no trace.
+    Writers of rejected rows pass logged=False, so convert_logged leaves
+    them out.'''
+    def __init__(self, outfile, mode='w', separator='\r\n', logged=True):
+        self.outfile = outfile
+        self.mode = mode
+        self.separator = separator
+        self.logged = logged
+        self.count = 0
+        self._file = None
+        self._size = None
+
+    def write(self, record):
+        if self._file is None:
+            if self.mode == 'a':
+                if os.path.exists(self.outfile):
+                    self._size = os.path.getsize(self.outfile)
+                self._file = open(self.outfile, 'a', BUFFER_SIZE)
+            else:
+                self._file = open(self.outfile + '.tmp', 'w', BUFFER_SIZE)
+            self._file.write(record)
+        else:
+            self._file.write(self.separator + record)
+        self.count += 1
+
+    def commit(self):
+        '''Finish the output, return True if anything was written.'''
+        if self._file is None:
+            return False
+        start = self._size or 0
+        end = self._file.tell()
+        self._file.close()
+        if self.mode != 'a':
+            replace_file(self.outfile + '.tmp', self.outfile)
+        if _writes is not None and self.logged:
+            _writes.append((self.outfile, self.mode, start, end - start))
+        return True
+
+    def discard(self):
+        if self._file is None:
+            return
+        self._file.close()
+        if self.mode != 'a':
+            os.remove(self.outfile + '.tmp')
+        elif self._size is None:
+            os.remove(self.outfile)
+        else:
+            with open(self.outfile, 'r+') as f:
+                f.truncate(self._size)
+
+
+# (outfile, mode, start, length) of each RecordWriter committed, while logged
+_writes = None
+
+
+def convert_logged(converter, filename):
+    '''Run converter(filename), return the (outfile, mode, start, length)
+    of every output it wrote.'''
+    global _writes
+    _writes = []
+    try:
+        converter(filename)
+        return _writes
+    finally:
+        _writes = None
 
 
 def convert_csv(infile, outfile, converter, file=None, mode='w', headers=0):
-    '''General purpose .CSV file conversion engine.'''
+    '''General purpose .CSV file conversion engine.
+
+    Rows are converted and written out one at a time, so memory use stays
+    flat however long the input. converter(values=, outfile=) returns the
+    output record, or '' to reject the row; rejected rows go to
+    {infile}.err as they turn up.'''
+    return convert_csv_fanout(infile, [(outfile, converter, mode)], file, headers)
+
+
+def convert_csv_fanout(infile, targets, file=None, headers=0):
+    '''Convert one .CSV file into several outputs in a single read.
+
+    targets are (outfile, converter, mode) and each row goes through every
+    converter, as in convert_csv. With more than one target, the rows each
+    converter rejects go to {infile}.{ext}.err, ext being its output's.'''
     # Convert data
-    print '{infile}  -->  {outfile}'.format(**locals())
-    with file or open(infile, 'r') as src:
-        output = []
-        unconverted = []
-        csv_reader = csv.reader(src)
-        for values in csv_reader:
-            #print '1', headers, values
-            if headers or not values[0]:
-                headers -= 1
-                continue
-
-            #print 'past'
-            converted = converter(**locals())
-            if len(converted) == 0:
-                if len(values[0]):
-                    unconverted.append(values)
-            else:
-                output.append(converted)
-                
-    if len(output):
-        with open(outfile, mode) as dst:
-            dst.write('\r\n'.join(output))
-        call(['chown', 'Administrators', outfile])
-    if len(unconverted):
-        print '\tunconverted rows in {infile}.err'.format(**locals())
-        with open(infile + '.err', 'w') as errors:
-            csv_writer = csv.writer(errors)
-            csv_writer.writerows(unconverted)
-        call(['chown', 'Administrators', infile + '.err'])
+    sinks = []
+    for outfile, converter, mode in targets:
+        print '{infile}  -->  {outfile}'.format(**locals())
+        errfile = infile + '.err'
+        if len(targets) > 1:
+            errfile = '{0}.{1}.err'.format(infile, outfile.rsplit('.', 1)[-1])
+        unconverted = RecordWriter(errfile, separator='', logged=False)
+        sinks.append((outfile, converter, RecordWriter(outfile, mode), unconverted,
+                      csv.writer(unconverted)))
+    try:
+        with file or open(infile, 'r') as src:
+            csv_reader = csv.reader(src)
+            for values in csv_reader:
+                #print '1', headers, values
+                if headers or not values[0]:
+                    headers -= 1
+                    continue
+
+                #print 'past'
+                for outfile, converter, dst, unconverted, csv_writer in sinks:
+                    converted = converter(values=values, outfile=outfile)
+                    if len(converted) == 0:
+                        if len(values[0]):
+                            csv_writer.writerow(values)
+                    else:
+                        dst.write(converted)
+    except:
+        for outfile, converter, dst, unconverted, csv_writer in sinks:
+            dst.discard()
+            unconverted.discard()
+        raise
+
+    for outfile, converter, dst, unconverted, csv_writer in sinks:
+        if dst.commit():
+            call(['chown', 'Administrators', outfile])
+        if unconverted.commit():
+            print '\tunconverted rows in {0}'.format(unconverted.outfile)
+            call(['chown', 'Administrators', unconverted.outfile])
 
     return True
 
 
+class FixedReader(object):
+    '''Split fixed-width lines into tuples of fields.
+
+    The field offsets are worked out once. A line that fills the record
+    is unpacked in one call; text past the last field is ignored. The line
+    ending is never part of a field, and a short line gives the field it
+    ends in cut short and '' for the fields after it.
+
+    usage:
+        reader = FixedReader([8, 6, 15])
+        for values in reader.read(open('AD150304.FIX')):
+            ...'''
+    def __init__(self, widths):
+        self.widths = list(widths)
+        self.size = sum(self.widths)
+        self._struct = struct.Struct(''.join('{0}s'.format(w) for w in self.widths))
+        self._slices = []
+        start = 0
+        for width in self.widths:
+            self._slices.append(slice(start, start + width))
+            start += width
+
+    def split(self, line):
+        end = len(line)
+        if line.endswith('\n'):
+            end -= 1
+            if line.endswith('\r\n'):
+                end -= 1
+        if end >= self.size:
+            return self._struct.unpack_from(line)
+        line = line[:end]
+        return tuple([line[s] for s in self._slices])
+
+    def read(self, lines):
+        split = self.split
+        for line in lines:
+            yield split(line)
+
+
 def convert_fixed(infile, outfile, fields, converter, file=None, mode='w'):
-    '''General purpose fixed-width file conversion engine.'''
+    '''General purpose fixed-width file conversion engine.
+
+    fields are the widths of the input columns, see FixedReader.
+    converter(values=, outfile=) returns the output record for each line,
+    and records are written out as they are made.'''
     # Convert data
     print '{infile}  -->  {outfile}'.format(**locals())
-    with file or open(infile, 'r') as src:
-        output = []
-        for line in src:
-            # Get distinct values from line of input
-            values = []
-            for field in fields:
-                values.append(line[:field])
-                line = line[field:]
-
-            output.append(converter(**locals()))
-
-    with open(outfile, mode) as dst:
-        dst.write('\r\n'.join(output))
-    call(['chown', 'Administrators', outfile])
+    dst = RecordWriter(outfile, mode)
+    reader = FixedReader(fields)
+    try:
+        with file or open(infile, 'r') as src:
+            for values in reader.read(src):
+                dst.write(converter(values=values, outfile=outfile))
+    except:
+        dst.discard()
+        raise
+
+    if dst.commit():
+        call(['chown', 'Administrators', outfile])
 
     return True
 
@@ -95,9 +340,8 @@ def convert_tiaa_cref_sec_file(infile, file=None):
         sec_type = 'mf'
         desc = values[2][0:40]
         cusip = values[21]
-        output = '{sec_type}{symbol:9}{desc:40}{cusip:>9}  0.00'
 
-        return output.format(**locals())
+        return SEC.format(sec_type, symbol, desc, cusip)
 
     return convert_csv(infile, outfile, sec, file)
 
@@ -105,14 +349,13 @@ def convert_tiaa_cref_sec_file(infile, file=None):
 def convert_tiaa_cref_pri_file(infile, file=None):
     '''Convert Prices export (.PRI) from TIAA-CREF to Fidelity format.'''
     outfile = get_fidelity_path_from_tiaa_cref(infile)
+    pc_datestr = os.path.basename(outfile)[2:8]
 
-    def pri(values, outfile, **kwargs):
+    def pri(values, **kwargs):
         symbol = 'tiaatrad-' if values[0].lower() == 'tiaatrad' else values[0].lower()
         price = float(values[3])
-        pc_datestr = os.path.basename(outfile)[2:8]
-        output = '{symbol:58}{price:>15.07f}{pc_datestr}'
 
-        return output.format(**locals())
+        return PRI.format(symbol, price, pc_datestr)
 
     return convert_csv(infile, outfile, pri, file)
 
@@ -120,8 +363,10 @@ def convert_tiaa_cref_pri_file(infile, file=None):
 def convert_tiaa_cref_pos_file(infile, file=None):
     '''Convert Reconciliation export (.POS) from TIAA-CREF to Fidelity format.'''
     outfile = get_fidelity_path_from_tiaa_cref(infile)
+    dts = os.path.basename(outfile)[2:8]
+    date_str = '20{}{}'.format(dts[-2:], dts[:-2])  # Convert MMDDYY to YYYYMMDD
 
-    def pos(values, outfile, **kwargs):
+    def pos(values, **kwargs):
         acct_num = values[0][-6:] + values[0][:8]
         sec_type = '' #values[2] and 'mf'  # Mutual Funds only from TIAA-CREF
         symbol = 'tiaatrad-' if values[3].lower() == 'tiaatrad' else values[3].lower()
@@ -134,21 +379,16 @@ def convert_tiaa_cref_pos_file(infile, file=None):
         trade_date_quantity = settle_date_quantity = quantity
         close_price = ''  # >15.05f
         description = ''
-        dts = os.path.basename(outfile)[2:8]
-        date_str = '20{}{}'.format(dts[-2:], dts[:-2])  # Convert MMDDYY to YYYYMMDD
         factor = face_amount = clean_price = factored = ''
         option_symbol = ''
         rep1 = '000'  # Apparently C&D-specific values
         rep2 = 'J62'  # Apparently C&D-specific values
 
         # NOTE: Verify the need for closing_price, cusip, and description
-        output = ('{acct_num:14} {acct_type:1d} {cusip:9} {symbol:9} '
-                  '{trade_date_quantity:>15.05f} {settle_date_quantity:>15.05f} '
-                  '{close_price:15} {description:40} {date_str:8} '
-                  '{factor:17} {face_amount:18} {clean_price:18} {factored:1} '
-                  '{sec_type:2} {option_symbol:30} {rep1:3}{rep2:3}')
-
-        return output.format(**locals())
+        return POS.format(acct_num, acct_type, cusip, symbol, trade_date_quantity,
+                          settle_date_quantity, close_price, description, date_str,
+                          factor, face_amount, clean_price, factored, sec_type,
+                          option_symbol, rep1, rep2)
 
     return convert_csv(infile, outfile, pos, file)
 
@@ -156,6 +396,11 @@ def convert_tiaa_cref_pos_file(infile, file=None):
 def convert_tiaa_cref_trd_file(infile, file=None):
     '''Conver Portfolio export (.TRD) from TIAA-CREF to Fidelity format.'''
     outfile = get_fidelity_path_from_tiaa_cref(infile)
+    pc_datestr = os.path.basename(outfile)[2:8]
+    month = int(pc_datestr[:2])
+    day = int(pc_datestr[2:4])
+    year = 2000 + int(pc_datestr[4:])
+    date_str = '{year:4d}{month:02d}{day:02d}'.format(**locals())
 
     def trd_nam(values, **kwargs):
         # broker = values[0] or 'TC'    # Not used
@@ -182,15 +427,13 @@ def convert_tiaa_cref_trd_file(infile, file=None):
         # default_acct = values[21]     # Not sent by TIAA-CREF
 
         # Other values
-        full_name = '{first_name} {last_name}'.format(**locals())[:48]
-        tacct_num = 'TC{}'.format(values[13][:8])
+        full_name = (first_name + ' ' + last_name)[:48]
+        tacct_num = 'TC' + values[13][:8]
         acct_num11 = acct_num[:11]
 
-        output = '{acct_num11:11}{tacct_num:10} {full_name}'
+        return NAM.format(acct_num11, tacct_num, full_name)
 
-        return output.format(**locals())
-
-    def trd_acc(values, outfile, **kwargs):
+    def trd_acc(values, **kwargs):
         last_name = values[1]
         first_name = values[2]
         tax_id = values[12] and ''
@@ -199,47 +442,31 @@ def convert_tiaa_cref_trd_file(infile, file=None):
         acct_type = values[18][:24]
 
         # Other values
-        full_name = '{first_name} {last_name}'.format(**locals())[:20]
-        tacct_num = 'TC{}'.format(values[13][:8])
-        pc_datestr = os.path.basename(outfile)[2:8]
-        month = int(pc_datestr[:2])
-        day = int(pc_datestr[2:4])
-        year = 2000 + int(pc_datestr[4:])
-        date_str = '{year:4d}{month:02d}{day:02d}'.format(**locals())
+        full_name = (first_name + ' ' + last_name)[:20]
+        tacct_num = 'TC' + values[13][:8]
         cost_basis = 'FIFO'
         corp_indicator = 'N'
 
-        output = ('{acct_num:14} {tax_id:11}     {full_name:20}     '
-                  '{tacct_num:10}     {acct_type:24}      {date_str:12} '
-                  '{cost_basis:4} {corp_indicator:1}')
-
-        return output.format(**locals())
+        return ACC.format(acct_num, tax_id, full_name, tacct_num, acct_type, date_str,
+                          cost_basis, corp_indicator)
 
-    outfile = outfile[:-4] + '.nam'
-    nam = convert_csv(infile, outfile, trd_nam, file)
-    outfile = outfile[:-4] + '.acc'
-    acc = convert_csv(infile, outfile, trd_acc, file)
+    # One read of the file makes both, so a zip member stream is enough
+    targets = [(outfile[:-4] + '.nam', trd_nam, 'w'),
+               (outfile[:-4] + '.acc', trd_acc, 'w')]
 
-    return nam and acc
+    return convert_csv_fanout(infile, targets, file)
 
 
 def convert_tiaa_cref_trn_file(infile, file=None):
     '''Convert Transaction export (.TRN) from TIAA-CREF to Fidelity format.'''
     outfile = get_fidelity_path_from_tiaa_cref(infile)
 
-    def trn(values, outfile, **kwargs):
+    def trn(values, **kwargs):
         broker = values[0] and 'TC'
         # values[1] not used
         # TC Acct#: 'AAAAAAAA BBBBBB CCCCCC' -> PC Acct#: 'AAAAAAAACCCCCC'
         acct_num = values[2][-6:] + values[2][:8]
-        trans_code = {'BUY': 'by',
-                      'SECBUY': 'dv',
-                      'DEP': 'dp',
-                      'DIV': 'dv',
-                      'INT': 'in',
-                      'SELL': 'sl',
-                      'WITH': 'wd',
-                      'MFEE': 'wd'}.get(values[3], '')
+        trans_code = TIAA_CREF_TRANS_CODES.get(values[3], '')
         if trans_code == '':
             return ''
         symbol = 'tiaatrad-' if values[5].lower() == 'tiaatrad' else values[5].lower()
@@ -273,12 +500,7 @@ def convert_tiaa_cref_trn_file(infile, file=None):
         
         # Other values
         sec_type_code = '' #'mf'
-        tk_code, tkc_desc = {'by': ('BOT', 'BOUGHT'),
-                             'dp': ('REC', 'RECEIVED FROM YOU'),
-                             'dv': ('DIV', 'DIVIDEND'),
-                             'in': ('INT', 'INTEREST'),
-                             'sl': ('SLD', 'SOLD'),
-                             'wd': ('DEL', 'DELIVERED TO YOU')}[trans_code]
+        tk_code, tkc_desc = TIAA_CREF_TK_CODES[trans_code]
         if values[3] == 'MFEE':
             tk_code, tkc_desc = 'ADF', 'ADVISOR FEE'
         if cancel == 'Y':
@@ -286,13 +508,11 @@ def convert_tiaa_cref_trn_file(infile, file=None):
         SEC_fee = 0.0
         option_symbol = ''
         order_action = ''
-        output = ('{acct_num:14}{trans_code:2} {trade_date:6} '
-                  '{sec_type_code:2} {symbol:9} {net_amount:>15.02f} {source:7} '
-                  '{quantity:>15.05f} {broker:7} {broker_fee:>9.02f} {tk_code:4} '
-                  '{tkc_desc:21} {other_fee:>16.04f} {SEC_fee:>16.04f} '
-                  '{option_symbol:30} {settle_date:6} {order_action:20}')
 
-        return output.format(**locals())
+        return TRN.format(acct_num, trans_code, trade_date, sec_type_code, symbol,
+                          net_amount, source, quantity, broker, broker_fee, tk_code,
+                          tkc_desc, other_fee, SEC_fee, option_symbol, settle_date,
+                          order_action)
 
     return convert_csv(infile, outfile, trn, file, mode='a')
 
@@ -301,7 +521,7 @@ def convert_tiaa_cref_ini_file(infile, file=None):
     '''Convert Initial Positions export (.INI) from TIAA-CREF to Fidelity format.'''
     outfile = get_fidelity_path_from_tiaa_cref(infile)
 
-    def ini(values, outfile, **kwargs):
+    def ini(values, **kwargs):
         broker = values[0] and 'TC'
         # file_date = values[1]         # Not sent by TIAA-CREF
         acct_num = values[2][-6:] + values[2][:8]
@@ -325,13 +545,10 @@ def convert_tiaa_cref_ini_file(infile, file=None):
 
         # NOTE: {trans_code: 'by', source: 'xxxxxxx', net_amount: 0.0}
         # for Receipt of Securities transaction
-        output = ('{acct_num:14}{trans_code:2} {trade_date:6} '
-                  '{sec_type_code:2} {symbol:9} {net_amount:>15.02f} {source:7} '
-                  '{quantity:>15.05f} {broker:7} {broker_fee:>9.02f} {tk_code:4} '
-                  '{tkc_desc:21} {other_fee:>16.04f} {SEC_fee:>16.04f} '
-                  '{option_symbol:30} {settle_date:6} {order_action:20}')
-
-        return output.format(**locals())
+        return TRN.format(acct_num, trans_code, trade_date, sec_type_code, symbol,
+                          net_amount, source, quantity, broker, broker_fee, tk_code,
+                          tkc_desc, other_fee, SEC_fee, option_symbol, settle_date,
+                          order_action)
 
     # .INI files are really just transactions, so append to .trn
     outfile = outfile[:-4] + '.trn'
@@ -348,8 +565,10 @@ def convert_schwab_pos_file(infile, file=None):
         acct_num = csv.readline().split()[4]
     acct_num = acct_num.replace('XXXX', os.path.basename(infile)[:4])
     outfile = 'fi' + acct_num + '_' + stamp + '.pos'
+    dts = os.path.basename(outfile)[2:8]
+    date_str = '20{}{}'.format(dts[-2:], dts[:-2])  # Convert MMDDYY to YYYYMMDD
 
-    def pos(values, outfile, acct_num=acct_num, **kwargs):
+    def pos(values, **kwargs):
         symbol = values[0]
         description = values[1][:40]
         quantity = float(values[2])
@@ -380,21 +599,16 @@ def convert_schwab_pos_file(infile, file=None):
         cusip = ''
         trade_date_quantity = settle_date_quantity = quantity
         close_price = ''  # >15.05f
-        dts = os.path.basename(outfile)[2:8]
-        date_str = '20{}{}'.format(dts[-2:], dts[:-2])  # Convert MMDDYY to YYYYMMDD
         factor = face_amount = clean_price = factored = ''
         option_symbol = ''
         rep1 = '000'  # Apparently C&D-specific values
         rep2 = 'J62'  # Apparently C&D-specific values
 
         # NOTE: Verify the need for closing_price, cusip, and description
-        output = ('{acct_num:14} {acct_type:1d} {cusip:9} {symbol:9} '
-                  '{trade_date_quantity:>15.05f} {settle_date_quantity:>15.05f} '
-                  '{close_price:15} {description:40} {date_str:8} '
-                  '{factor:17} {face_amount:18} {clean_price:18} {factored:1} '
-                  '{sec_type:2} {option_symbol:30} {rep1:3}{rep2:3}')
-
-        return output.format(**locals())
+        return POS.format(acct_num, acct_type, cusip, symbol, trade_date_quantity,
+                          settle_date_quantity, close_price, description, date_str,
+                          factor, face_amount, clean_price, factored, sec_type,
+                          option_symbol, rep1, rep2)
 
     return convert_csv(infile, outfile, pos, file, mode='a', headers=3)
 
@@ -406,39 +620,15 @@ def convert_schwab_trn_file(infile, file=None):
 #    acct_num = acct_num.replace('XXXX', os.path.basename(infile)[:4])
     outfile = 'fi' + os.path.basename(infile)[2:12]
 
-    def trn(values, outfile, **kwargs):
+    def trn(values, **kwargs):
         #print values
         settle_date = values[0][:2] + values[0][3:5] + values[0][8:10]
         if len(values[0]) < 20:
             trade_date = settle_date
         else:
             trade_date = values[0][17:19] + values[0][20:22] + values[0][25:27]
-        table = {'Buy': ('by', 'BOT', 'BOUGHT', 'cash'),
-                 'Reinvest Shares': ('by', 'RIN', 'REINVESTMENT', 'cash'),
-                 'Sell': ('sl', 'SLD', 'SOLD', 'cash'),
-                 'CD Deposit Adj': ('cd', 'RDM', 'REDEEMED', 'cash'),
-                 'CD Deposit Funds': ('skip', '', '', ''),
-                 'Security Transfer': ('st', 'TFR', 'TRANSFERRED', 'cash'),
-                 'Principal Payment': ('rc', 'PRN', 'PRINCIPAL PAYMENT', 'cash'),
-                 'Bond Interest': ('in', 'INT', 'INTEREST', 'cash'),
-                 'Bank Interest': ('in', 'INT', 'INTEREST', 'cash'),
-                 'CD Interest': ('in', 'INT', 'INTEREST', 'cash'),
-                 'Tax Withholding': ('pn', 'PN', 'TAX W/H', 'cash'),
-                 'Stock Split': ('by', 'DST', 'DISTRIBUTION', 'cash'),
-                 'Advisor Fee': ('wd', 'ADF', 'ADVISOR FEE', 'client'),
-                 'Funds Paid': ('wd', 'DEL', 'DELIVERED TO YOU', 'client'),
-                 'Auto S1 Debit': ('wd', 'DEL', 'DELIVERED TO YOU', 'client'),
-                 'Visa Purchase': ('wd', 'DEL', 'DELIVERED TO YOU', 'client'),
-                 'ATM Withdrawal': ('wd', 'DEL', 'DELIVERED TO YOU', 'client'),
-                 'Funds Received': ('dp', 'REC', 'RECEIVED FROM YOU', 'client'),
-                 'Auto S1 Credit': ('dp', 'REC', 'RECEIVED FROM YOU', 'client'),
-                 'Schwab ATM Rebate': ('dp', 'REC', 'RECEIVED FROM YOU', 'client'),
-                 'Pr Yr Cash Div': ('dv', 'DIV', 'DIVIDEND', 'cash'),
-                 'Qualified Dividend': ('dv', 'DIV', 'DIVIDEND', 'cash'),
-                 'Reinvest Dividend': ('rdv', 'DIV', 'DIVIDEND', 'dvwash'),
-                 'Reinvest Shares': ('rby', 'RIN', 'REINVESTMENT', 'dvsplit'),
-                 'Cash Dividend': ('dv', 'DIV', 'DIVIDEND', 'cash')}
-        trans_code, tk_code, tkc_desc, source = table.get(values[1].strip(), ('', '', '', ''))
+        trans_code, tk_code, tkc_desc, source = SCHWAB_ACTIONS.get(values[1].strip(),
+                                                                   ('', '', '', ''))
         if trans_code == '':
             return ''
         if trans_code == 'skip':
@@ -496,13 +686,11 @@ def convert_schwab_trn_file(infile, file=None):
         SEC_fee = 0.0
         option_symbol = ''
         order_action = ''
-        output = ('{acct_num:14}{trans_code:2} {trade_date:6} '
-                  '{sec_type_code:2} {symbol:9} {net_amount:>15.02f} {source:7} '
-                  '{quantity:>15.05f} {broker:7} {broker_fee:>9.02f} {tk_code:4} '
-                  '{tkc_desc:21} {other_fee:>16.04f} {SEC_fee:>16.04f} '
-                  '{option_symbol:30} {settle_date:6} {order_action:20}')
 
-        return output.format(**locals())
+        return TRN.format(acct_num, trans_code, trade_date, sec_type_code, symbol,
+                          net_amount, source, quantity, broker, broker_fee, tk_code,
+                          tkc_desc, other_fee, SEC_fee, option_symbol, settle_date,
+                          order_action)
 
     return convert_csv(infile, outfile, trn, file, mode='a')
 
@@ -514,20 +702,11 @@ def convert_fidelity_hist_file(infile, file=None):
     outfile = 'converted.trn'
     acct_num = infile.split('AccountHistoryFor')[1][:10]
 
-    def trn(values, outfile, acct_num=acct_num, **kwargs):
+    def trn(values, **kwargs):
         # values[0] == entry date
-        months = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04',
-                  'May': '05', 'Jun': '06', 'Jul': '07', 'Aug': '08',
-                  'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
-        trade_date = months[values[1][3:6]] + values[1][:2] + values[1][9:11]
-        settle_date = months[values[2][3:6]] + values[2][:2] + values[2][9:11]
-        trans_code = {'Buy': 'by',
-                      'Sell': 'sl',
-                      'Withdrawal': 'wd',
-                      'Deposit': 'dp',
-                      'Fee': 'dp',
-                      'Interest': 'in',
-                      'Dividend': 'dv',}.get(values[3].strip(), '')
+        trade_date = MONTHS[values[1][3:6]] + values[1][:2] + values[1][9:11]
+        settle_date = MONTHS[values[2][3:6]] + values[2][:2] + values[2][9:11]
+        trans_code = FIDELITY_TRANS_CODES.get(values[3].strip(), '')
         if trans_code == '':
             return ''
         # values[4] == transaction description
@@ -552,21 +731,7 @@ def convert_fidelity_hist_file(infile, file=None):
         tk_code = values[22]
 
         # Other values
-        tkc_desc = {'BOT': 'BOUGHT',
-                    'BUY': 'BOUGHT',
-                    'SLD': 'SOLD',
-                    'SEL': 'SOLD',
-                    'JNL': 'JOURNAL',
-                    'ADF': 'ADVISOR FEE',
-                    'INT': 'INTEREST',
-                    'DST': 'DISTRIBUTION',
-                    'RDM': 'REDEEMED',
-                    'PDP': 'NORMAL DISTR PARTIAL',
-                    'ETT': 'MONEY LINE PAID EFT',
-                    'FPN': 'FED TAX W/H',
-                    'SPN': 'STATE TAX W/H',
-                    'RIN': 'REINVESTMENT',
-                    'DIV': 'DIVIDEND',}[tk_code]
+        tkc_desc = TK_DESCRIPTIONS[tk_code]
         broker = ''
         sec_type_code = ''
         source = 'client' if trans_code in ['dp', 'wd'] else 'cash'
@@ -574,13 +739,11 @@ def convert_fidelity_hist_file(infile, file=None):
         SEC_fee = 0.0
         option_symbol = ''
         order_action = ''
-        output = ('{acct_num:14}{trans_code:2} {trade_date:6} '
-                  '{sec_type_code:2} {symbol:9} {net_amount:>15.02f} {source:7} '
-                  '{quantity:>15.05f} {broker:7} {broker_fee:>9.02f} {tk_code:4} '
-                  '{tkc_desc:21} {other_fee:>16.04f} {SEC_fee:>16.04f} '
-                  '{option_symbol:30} {settle_date:6} {order_action:20}')
 
-        return output.format(**locals())
+        return TRN.format(acct_num, trans_code, trade_date, sec_type_code, symbol,
+                          net_amount, source, quantity, broker, broker_fee, tk_code,
+                          tkc_desc, other_fee, SEC_fee, option_symbol, settle_date,
+                          order_action)
 
     return convert_csv(infile, outfile, trn, file, mode='a', headers=5)
 
@@ -596,7 +759,7 @@ def convert_plandestination_file(infile, file=None):
     outfile2 = filename + '.pos'
     acct_num = '000000000'
 
-    def trn(values, outfile=outfile1, acct_num=acct_num, **kwargs):
+    def trn(values, **kwargs):
         trade_date = '{0:0>2}{1:0>2}{2[2]}{2[3]}'.format(*values[0].split('/'))
         #settle_date = trade_date
         trans_code = 'by' if values[1] == 'BUY' else 'sl'
@@ -607,18 +770,7 @@ def convert_plandestination_file(infile, file=None):
         quantity =  float(values[7])
         # values[8] == price
         net_amount = abs(float(values[9][1:]))
-        # values[10] == activity
-        {'ASSET ALLOCATION': 'BOT|SLD',
-         'Corporate Fund Merger Adj': '',
-         'EMPLOYEE PRE-TAX CONTRIBUTION': '',
-         'EMPLOYER MATCHING CONTRIBUTION': '',
-         'INCOME ADJUSTMENT': '',
-         'PURCHASE DUE TO FUND SWAP': '',
-         'PURCHASE DUE TO FUND TRANSFER': '',
-         'REINVESTED DIVIDEND': 'DIV->RIN',
-         'SALE DUE TO FUND SWAP': '',
-         'SALE DUE TO FUND TRANSFER': '',
-         'TRANSFER TO PERMANENT INVESTMENT': 'REC',}
+        # values[10] == activity, see PLANDESTINATION_ACTIVITIES
 
         #if trans_code == '':
             #return ''
@@ -628,54 +780,308 @@ def convert_plandestination_file(infile, file=None):
         source = 'client' if trans_code in ['dp', 'wd'] else 'cash'
         broker = ''
         tk_code = values[22]
-        tkc_desc = {'BOT': 'BOUGHT',
-                    'BUY': 'BOUGHT',
-                    'SLD': 'SOLD',
-                    'SEL': 'SOLD',
-                    'JNL': 'JOURNAL',
-                    'ADF': 'ADVISOR FEE',
-                    'INT': 'INTEREST',
-                    'DST': 'DISTRIBUTION',
-                    'RDM': 'REDEEMED',
-                    'PDP': 'NORMAL DISTR PARTIAL',
-                    'ETT': 'MONEY LINE PAID EFT',
-                    'FPN': 'FED TAX W/H',
-                    'SPN': 'STATE TAX W/H',
-                    'RIN': 'REINVESTMENT',
-                    'DIV': 'DIVIDEND',}[tk_code]
+        tkc_desc = TK_DESCRIPTIONS[tk_code]
         other_fee = 0.0
         SEC_fee = 0.0
         option_symbol = ''
         order_action = ''
-        output = ('{acct_num:14}{trans_code:2} {trade_date:6} '
-                  '{sec_type_code:2} {symbol:9} {net_amount:>15.02f} {source:7} '
-                  '{quantity:>15.05f} {broker:7} {broker_fee:>9.02f} {tk_code:4} '
-                  '{tkc_desc:21} {other_fee:>16.04f} {SEC_fee:>16.04f} '
-                  '{option_symbol:30} {settle_date:6} {order_action:20}')
 
-        return output.format(**locals())
+        return TRN.format(acct_num, trans_code, trade_date, sec_type_code, symbol,
+                          net_amount, source, quantity, broker, broker_fee, tk_code,
+                          tkc_desc, other_fee, SEC_fee, option_symbol, settle_date,
+                          order_action)
 
     return convert_csv(infile, outfile, trn, file, mode='a', headers=5)
 
 
+def get_fidelity_trn_path_from_tiaa_cref(tc_path):
+    '''The .trn file a TIAA-CREF .INI or .TRN file is appended to.'''
+    return get_fidelity_path_from_tiaa_cref(tc_path)[:-4] + '.trn'
+
+
+def path_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def file_digest(filename):
+    '''Return the SHA-1 of a file's content.'''
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def copy_range(src, dst, start, length):
+    '''Copy length bytes of file src, from start, to file dst.'''
+    src.seek(start)
+    while length > 0:
+        chunk = src.read(min(length, BUFFER_SIZE))
+        if not chunk:
+            break
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def rewrite_file(filename, ranges):
+    '''Replace a file with the (start, length) ranges of it, in order.'''
+    with open(filename, 'rb') as src:
+        with open(filename + '.tmp', 'wb') as dst:
+            for start, length in ranges:
+                copy_range(src, dst, start, length)
+    replace_file(filename + '.tmp', filename)
+
+
+class Manifest(object):
+    """What each input was converted into, kept in {directory}/fidoconvert.manifest.
+
+    An input is known by its size, modification time and SHA-1; it is
+    only hashed again when the size and time don't match. Every output
+    is kept as the segments the inputs added to it, in file order, so a
+    changed input's records can be replaced where they are.
+
+    usage:
+        manifest = Manifest(directory)
+        if manifest.prepare(filename):
+            manifest.finish(filename, convert_logged(converter, filename))
+        manifest.save()"""
+    def __init__(self, directory, reconvert=False):
+        self.filename = os.path.join(directory, MANIFEST)
+        self.reconvert = reconvert
+        self.inputs = {}
+        self.outputs = {}
+        self._pending = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                manifest = json.load(f)
+            self.inputs = manifest['inputs']
+            self.outputs = manifest['outputs']
+
+    def prepare(self, filename):
+        '''Return True if filename needs converting.
+
+        A changed input has its records cut out of the files it appended
+        to, keeping their place for the records that replace them.'''
+        key = path_key(filename)
+        stat = os.stat(filename)
+        entry = self.inputs.get(key)
+        sha1 = None
+        if entry and not self.reconvert and entry['size'] == stat.st_size:
+            if entry['mtime'] == stat.st_mtime:
+                return False
+            sha1 = file_digest(filename)
+            if entry['sha1'] == sha1:
+                entry['mtime'] = stat.st_mtime
+                return False
+
+        if entry:
+            for output, mode in entry['outputs'].iteritems():
+                if mode == 'a':
+                    self.cut(output, key)
+            del self.inputs[key]
+        self._pending[key] = (sha1 or file_digest(filename), stat.st_size, stat.st_mtime)
+        return True
+
+    def cut(self, output, key):
+        '''Take the records of input key out of output, leaving their place.'''
+        segments = self.outputs.get(output)
+        if not segments:
+            return
+        if not os.path.exists(output):
+            del self.outputs[output]
+            return
+        size = os.path.getsize(output)
+        if sum(length for _, length in segments) != size:
+            print '\t{0} was changed by hand, not replacing records in it'.format(output)
+            self.outputs[output] = [[None, size]]
+            return
+
+        kept = []
+        start = 0
+        for segment in segments:
+            if segment[0] != key:
+                kept.append((start, segment[1]))
+            start += segment[1]
+            if segment[0] == key:
+                segment[1] = 0
+        if sum(length for _, length in kept) == 0:
+            os.remove(output)
+        else:
+            rewrite_file(output, kept)
+
+    def finish(self, filename, writes):
+        '''Record what filename was converted into.
+
+        An input that produced nothing but rejected rows is not recorded,
+        so it is converted again next time.'''
+        key = path_key(filename)
+        sha1, size, mtime = self._pending.pop(key)
+        if not writes:
+            return
+        outputs = {}
+        for outfile, mode, start, length in writes:
+            output = path_key(outfile)
+            outputs[output] = mode
+            if mode == 'a':
+                self.place(output, key, start, length)
+            else:
+                self.outputs[output] = [[key, length]]
+        self.inputs[key] = {'sha1': sha1, 'size': size, 'mtime': mtime,
+                            'outputs': outputs}
+
+    def place(self, output, key, start, length):
+        '''Account for records appended to output, moving them back to
+        where the input's earlier records were cut out.'''
+        segments = self.outputs.setdefault(output, [])
+        known = sum(length for _, length in segments)
+        if known > start:
+            segments[:] = [[None, start]]
+        elif known < start:
+            segments.append([None, start - known])
+
+        for index, segment in enumerate(segments):
+            if segment[0] == key and segment[1] == 0:
+                break
+        else:
+            segments.append([key, length])
+            return
+
+        offset = sum(length for _, length in segments[:index])
+        if offset < start:
+            rewrite_file(output, [(0, offset), (start, length), (offset, start - offset),
+                                  (start + length, os.path.getsize(output))])
+        segments[index][1] = length
+
+    def forget(self, filename):
+        '''Drop a file that failed to convert.'''
+        self._pending.pop(path_key(filename), None)
+
+    def save(self):
+        '''Write the manifest, without inputs renamed to backups or removed
+        and outputs that are gone.'''
+        for key in self.inputs.keys():
+            if not os.path.exists(key):
+                del self.inputs[key]
+        for output, segments in self.outputs.items():
+            segments[:] = [segment for segment in segments if segment[1]]
+            if not segments or not os.path.exists(output):
+                del self.outputs[output]
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump({'inputs': self.inputs, 'outputs': self.outputs}, f,
+                      separators=(',', ':'))
+        replace_file(self.filename + '.tmp', self.filename)
+
+
+def backup(filename, backup_extension):
+    if backup_extension:
+        os.rename(filename, filename[:-3] + backup_extension)
+
+
+def convert_chain(chain):
+    '''Convert [(converter, filename, backup_extension)] in order.
+
+    Each file is backed up right after it converts. The chain stops at
+    the first failure, so files after it never append out of order.
+    Returns ([(filename, writes)] converted, filename failed or None,
+    traceback, printed), writes as from convert_logged. What the converters
+    print is collected in printed, for the parent to print in one piece,
+    so the lines of processes running at once don't mix.'''
+    converted = []
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        for converter, filename, backup_extension in chain:
+            try:
+                writes = convert_logged(converter, filename)
+                backup(filename, backup_extension)
+            except Exception:
+                return converted, filename, traceback.format_exc(), sys.stdout.getvalue()
+            converted.append((filename, writes))
+        return converted, None, None, sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+def convert_parallel(jobs, processes, manifest=None):
+    '''Convert [(output, converter, filename, backup_extension)] in a pool.
+
+    Jobs with the same output run one after another, in the order given,
+    in one process. Inputs the manifest has seen unchanged are only
+    backed up. Returns the number of files that failed or were skipped
+    after a failure.'''
+    chains = OrderedDict()
+    for output, converter, filename, backup_extension in jobs:
+        if manifest and not manifest.prepare(filename):
+            print '{0} unchanged'.format(filename)
+            backup(filename, backup_extension)
+            continue
+        chains.setdefault(path_key(output), []).append(
+            (converter, filename, backup_extension))
+    if not chains:
+        return 0
+
+    failed = 0
+    pool = Pool(max(1, min(processes, len(chains))))
+    try:
+        for chain, (converted, filename, error, printed) in zip(
+                chains.itervalues(), pool.imap(convert_chain, chains.values())):
+            sys.stdout.write(printed)
+            if manifest:
+                for converted_filename, writes in converted:
+                    manifest.finish(converted_filename, writes)
+                for converter, chain_filename, backup_extension in chain[len(converted):]:
+                    manifest.forget(chain_filename)
+            if filename:
+                skipped = len(chain) - len(converted) - 1
+                failed += skipped + 1
+                print 'FAILED {0}'.format(filename)
+                print error
+                if skipped:
+                    print '\tskipped {0} later file(s) for the same output'.format(skipped)
+    finally:
+        pool.close()
+        pool.join()
+
+    return failed
+
+
 def main():
     '''convert downloaded data files to Fidelity format'''
 
     # Small class to collect conversion details
     class Conversion(object):
-        def __init__(self, glob_pattern, converter, backup_extension):
+        def __init__(self, glob_pattern, converter, backup_extension, output=None):
             self.glob_pattern = glob_pattern
             self.converter = converter
             self.backup_extension = backup_extension
-
-        def convert_path(self, path, skip_backup=False):
+            # The file each input converts into, when it can be told up
+            # front; otherwise all inputs share one output
+            self.output = output or (lambda filename: glob_pattern)
+
+        def jobs(self, path, skip_backup=False):
+            '''Return (output, converter, filename, backup_extension) per match.'''
+            filenames = sorted(glob.glob(os.path.join(path, self.glob_pattern)))
+            backup_extension = None if skip_backup else self.backup_extension
+            return [(self.output(filename), self.converter, filename, backup_extension)
+                    for filename in filenames]
+
+        def convert_path(self, path, skip_backup=False, manifest=None):
             glob_pattern = os.path.join(path, self.glob_pattern)
             print 'Matching ' + glob_pattern
             filenames = glob.iglob(glob_pattern)
             if not skip_backup:
                 print '\t', 'Backing up files to *.{0}'.format(self.backup_extension)
             for filename in filenames:
-                self.converter(filename)
+                if manifest is None:
+                    self.converter(filename)
+                elif manifest.prepare(filename):
+                    try:
+                        writes = convert_logged(self.converter, filename)
+                    except:
+                        manifest.forget(filename)
+                        raise
+                    manifest.finish(filename, writes)
+                else:
+                    print '{0} unchanged'.format(filename)
                 if not skip_backup:
                     os.rename(filename, filename[:-3] + self.backup_extension)
             print '----'
@@ -683,12 +1089,18 @@ def main():
     # The conversions, as available, by custodian
     custodians = {
         'tiaacref': {
-            'ini': Conversion('[aA][dD]*.[iI][nN][iI]', convert_tiaa_cref_ini_file, 'bai'),
-            'pos': Conversion('[aA][dD]*.[pP][oO][sS]', convert_tiaa_cref_pos_file, 'bas'),
-            'pri': Conversion('[aA][dD]*.[pP][rR][iI]', convert_tiaa_cref_pri_file, 'bap'),
-            'sec': Conversion('[aA][dD]*.[sS][eE][cC]', convert_tiaa_cref_sec_file, 'bac'),
-            'trd': Conversion('[aA][dD]*.[tT][rR][dD]', convert_tiaa_cref_trd_file, 'bcd'),
-            'trn': Conversion('[aA][dD]*.[tT][rR][nN]', convert_tiaa_cref_trn_file, 'bak'),
+            'ini': Conversion('[aA][dD]*.[iI][nN][iI]', convert_tiaa_cref_ini_file, 'bai',
+                              get_fidelity_trn_path_from_tiaa_cref),
+            'pos': Conversion('[aA][dD]*.[pP][oO][sS]', convert_tiaa_cref_pos_file, 'bas',
+                              get_fidelity_path_from_tiaa_cref),
+            'pri': Conversion('[aA][dD]*.[pP][rR][iI]', convert_tiaa_cref_pri_file, 'bap',
+                              get_fidelity_path_from_tiaa_cref),
+            'sec': Conversion('[aA][dD]*.[sS][eE][cC]', convert_tiaa_cref_sec_file, 'bac',
+                              get_fidelity_path_from_tiaa_cref),
+            'trd': Conversion('[aA][dD]*.[tT][rR][dD]', convert_tiaa_cref_trd_file, 'bcd',
+                              get_fidelity_path_from_tiaa_cref),
+            'trn': Conversion('[aA][dD]*.[tT][rR][nN]', convert_tiaa_cref_trn_file, 'bak',
+                              get_fidelity_trn_path_from_tiaa_cref),
         },
         'schwab': {
             'pos': Conversion('*pos.CSV', convert_schwab_pos_file, 'bsv'),
@@ -713,6 +1125,12 @@ def main():
                         help='original files are not renamed after conversion')
     parser.add_argument('-d', '--history-download', nargs=1, type=file,
                         help='convert a history file downloaded from Fidelity')
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS,
+                        help='number of files to convert at once')
+    parser.add_argument('-r', '--reconvert', action='store_true',
+                        help='convert files again even if they have not changed')
+    parser.add_argument('-n', '--no-manifest', action='store_true',
+                        help='do not keep track of converted files in ' + MANIFEST)
     args = parser.parse_args()
 
     # Convert a history .csv from Fidelity website export
@@ -725,15 +1143,32 @@ def main():
     # Get the conversions from the chosen custodian
     conversions = custodians[args.custodian]
 
-    # If no filetype is given, choose all filetypes for current custodian
+    # If no filetype is given, choose all filetypes for current custodian,
+    # in name order so .INI positions are appended before .TRN transactions
     if args.filetype is None:
-        args.filetype = conversions.iterkeys()
-
-    # Convert each filetype
-    for filetype in args.filetype:
-        print 'Converting {0} files for custodian: {1}'.format(filetype, args.custodian)
-        conversion = conversions[filetype]
-        conversion.convert_path(args.path, args.skip_backup)
+        args.filetype = sorted(conversions)
+
+    # Inputs converted before are skipped unless they changed
+    manifest = None if args.no_manifest else Manifest(args.path, args.reconvert)
+
+    try:
+        # Convert files in a pool, one process per output file at a time
+        if args.jobs > 1:
+            jobs = []
+            for filetype in args.filetype:
+                jobs.extend(conversions[filetype].jobs(args.path, args.skip_backup))
+            print 'Converting {0} files for custodian: {1}, {2} at once'.format(
+                len(jobs), args.custodian, args.jobs)
+            return 1 if convert_parallel(jobs, args.jobs, manifest) else 0
+
+        # Convert each filetype
+        for filetype in args.filetype:
+            print 'Converting {0} files for custodian: {1}'.format(filetype, args.custodian)
+            conversion = conversions[filetype]
+            conversion.convert_path(args.path, args.skip_backup, manifest)
+    finally:
+        if manifest:
+            manifest.save()
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
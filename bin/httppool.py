@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+'''Shared keep-alive HTTP connections for price downloads.
+
+Connections are pooled per host and handed back after each response is
+read, so repeated requests to the same quote server skip the TCP connect
+and DNS lookup. A per-host cap limits the connections open at once.'''
+
+# Standard libraries
+import httplib
+import os
+import socket
+import threading
+import urlparse
+from contextlib import contextmanager
+
+
+TIMEOUT = float(os.environ.get('PRICE_TIMEOUT', 30))
+MAX_CONNECTIONS = int(os.environ.get('PRICE_MAX_CONNECTIONS', 8))
+MAX_REDIRECTS = 5
+DRAIN_LIMIT = 64 * 1024
+REDIRECTS = (301, 302, 303, 307)
+HEADERS = {'User-Agent': 'Mozilla/5.0 (compatible; candd-pricer)',
+           'Connection': 'keep-alive'}
+
+
+class ConnectionPool(object):
+    """Keep-alive connections, pooled by (scheme, host).
+
+    usage:
+        pool = ConnectionPool(max_connections=4, timeout=10)
+        with pool.open(url) as response:
+            content = response.read()
+
+    A connection returns to the pool only when its response was read to
+    the end, unread responses up to DRAIN_LIMIT bytes are read off first,
+    otherwise the connection is closed. A reader that stops early saves
+    the work on the rest, not its download; the bytes read off are kept
+    in response.drained."""
+    def __init__(self, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_connections)
+            return self._slots[key]
+
+    def _connect(self, key):
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _release(self, key, conn, response):
+        # Finish reading short responses so their connection can be reused
+        response.drained = 0
+        if (not response.isclosed() and response.length is not None
+                and response.length <= DRAIN_LIMIT):
+            try:
+                response.drained = len(response.read())
+            except (httplib.HTTPException, socket.error):
+                pass
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self._slot(key).release()
+
+    def _get(self, url, headers):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme or 'http', parts.netloc)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        headers = dict(HEADERS, **(headers or {}))
+
+        self._slot(key).acquire()
+        conn = None
+        try:
+            conn, reused = self._checkout(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # The server dropped an idle connection, try a fresh one
+                conn = self._connect(key)
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+        except:
+            if conn is not None:
+                conn.close()
+            self._slot(key).release()
+            raise
+
+        return key, conn, response
+
+    @contextmanager
+    def open(self, url, headers=None):
+        '''Yield the response to a GET of url, following redirects.'''
+        for redirect in range(MAX_REDIRECTS + 1):
+            key, conn, response = self._get(url, headers)
+            location = response.getheader('location')
+            if response.status not in REDIRECTS or not location:
+                break
+            response.read()
+            self._release(key, conn, response)
+            url = urlparse.urljoin(url, location)
+        else:
+            raise httplib.HTTPException('Too many redirects: ' + url)
+
+        try:
+            yield response
+        finally:
+            self._release(key, conn, response)
+
+    def read(self, url, headers=None):
+        '''Return the body of a GET of url.'''
+        with self.open(url, headers) as response:
+            return response.read()
+
+    def close(self):
+        '''Close all idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.itervalues():
+            for conn in connections:
+                conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''Return the pool shared by every price download.'''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+def configure(max_connections=None, timeout=None):
+    '''Replace the shared pool with one using new limits.'''
+    global _pool
+    with _pool_lock:
+        old, _pool = _pool, ConnectionPool(
+            MAX_CONNECTIONS if max_connections is None else max_connections,
+            TIMEOUT if timeout is None else timeout)
+    if old is not None:
+        old.close()
+    return _pool
+
+
+def urlopen(url, headers=None):
+    '''Open url on the shared pool, for use in a with statement.'''
+    return get_pool().open(url, headers)
+
+
+def read(url, headers=None):
+    '''Return the body of url, read over the shared pool.'''
+    return get_pool().read(url, headers)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+'''Fixed-width record layouts of the Fidelity interface files.
+
+A layout lists its fields in order, with their widths, alignment and
+numeric precision, and the literal text between them. Each layout is
+compiled once into a positional format string, so formatting a record is
+one call with the field values in layout order:
+
+    TRN.format(acct_num, trans_code, trade_date, ...)
+
+Run this module to print the layouts.'''
+
+# Standard libraries
+import argparse
+
+
+class Field(object):
+    """One field of a record: its name, width, alignment and format spec."""
+    def __init__(self, name, width=None, align='', spec=''):
+        self.name = name
+        self.width = width
+        self.align = align
+        self.spec = spec
+
+    def template(self, key):
+        spec = '{0}{1}{2}'.format(self.align, self.width or '', self.spec)
+        if spec:
+            return '{{{0}:{1}}}'.format(key, spec)
+        return '{{{0}}}'.format(key)
+
+
+def text(name, width=None, align=''):
+    '''A text field, left aligned unless align says otherwise.'''
+    return Field(name, width, align)
+
+
+def number(name, width, places):
+    '''A right aligned decimal number with a fixed number of places.'''
+    return Field(name, width, '>', '.{0:02d}f'.format(places))
+
+
+def integer(name, width):
+    return Field(name, width, spec='d')
+
+
+class Layout(object):
+    """A record layout, compiled into a positional format string.
+
+    usage:
+        PRI = Layout('pri', [text('symbol', 58), number('price', 15, 7),
+                             text('date')])
+        PRI.format('qcstrx', 321.1234567, '030415')
+
+    `named` is the same template with field names, for reading."""
+    def __init__(self, name, parts):
+        self.name = name
+        self.fields = [part for part in parts if isinstance(part, Field)]
+        self.names = [field.name for field in self.fields]
+        positional = []
+        named = []
+        index = 0
+        for part in parts:
+            if isinstance(part, Field):
+                positional.append(part.template(index))
+                named.append(part.template(part.name))
+                index += 1
+            else:
+                positional.append(part.replace('{', '{{').replace('}', '}}'))
+                named.append(part.replace('{', '{{').replace('}', '}}'))
+        self.template = ''.join(positional)
+        self.named = ''.join(named)
+        self.format = self.template.format
+
+    def __repr__(self):
+        return 'Layout({0!r}, {1!r})'.format(self.name, self.named)
+
+
+TRN = Layout('trn', [
+    text('acct_num', 14), text('trans_code', 2), ' ', text('trade_date', 6), ' ',
+    text('sec_type_code', 2), ' ', text('symbol', 9), ' ',
+    number('net_amount', 15, 2), ' ', text('source', 7), ' ',
+    number('quantity', 15, 5), ' ', text('broker', 7), ' ',
+    number('broker_fee', 9, 2), ' ', text('tk_code', 4), ' ',
+    text('tkc_desc', 21), ' ', number('other_fee', 16, 4), ' ',
+    number('SEC_fee', 16, 4), ' ', text('option_symbol', 30), ' ',
+    text('settle_date', 6), ' ', text('order_action', 20)])
+
+POS = Layout('pos', [
+    text('acct_num', 14), ' ', integer('acct_type', 1), ' ', text('cusip', 9), ' ',
+    text('symbol', 9), ' ', number('trade_date_quantity', 15, 5), ' ',
+    number('settle_date_quantity', 15, 5), ' ', text('close_price', 15), ' ',
+    text('description', 40), ' ', text('date_str', 8), ' ', text('factor', 17), ' ',
+    text('face_amount', 18), ' ', text('clean_price', 18), ' ', text('factored', 1), ' ',
+    text('sec_type', 2), ' ', text('option_symbol', 30), ' ', text('rep1', 3),
+    text('rep2', 3)])
+
+PRI = Layout('pri', [
+    text('symbol', 58), number('price', 15, 7), text('pc_datestr')])
+
+SEC = Layout('sec', [
+    text('sec_type'), text('symbol', 9), text('desc', 40), text('cusip', 9, '>'),
+    '  0.00'])
+
+NAM = Layout('nam', [
+    text('acct_num11', 11), text('tacct_num', 10), ' ', text('full_name')])
+
+ACC = Layout('acc', [
+    text('acct_num', 14), ' ', text('tax_id', 11), '     ', text('full_name', 20),
+    '     ', text('tacct_num', 10), '     ', text('acct_type', 24), '      ',
+    text('date_str', 12), ' ', text('cost_basis', 4), ' ',
+    text('corp_indicator', 1)])
+
+LAYOUTS = dict((layout.name, layout) for layout in [TRN, POS, PRI, SEC, NAM, ACC])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('layout', nargs='*', choices=[[]] + sorted(LAYOUTS),
+                        help='layouts to print, all by default')
+    args = parser.parse_args()
+
+    for name in args.layout or sorted(LAYOUTS):
+        print '{0}: {1}'.format(name, LAYOUTS[name].named)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+'''Long-running price service shared by pricer, batcher and the GUI.
+
+The daemon owns the price cache, the keep-alive connections, the rate
+limits and the parsed CREF CSV files, so scripts that start cold can hand
+it their (symbol, dates) lookups instead of fetching them themselves.
+Clients use it when PRICED_ADDRESS is set, to either HOST:PORT or the
+path of a Unix socket. When it is empty, or nothing answers there, pricer
+fetches in-process as before.
+
+Requests and answers are lines of JSON. A request lists lookups and the
+options the client prices with (see pricer.lookup_options),
+
+    {"lookups": [["SPY", ["2015-03-04", "2015-03-05"]], ["AGG", ["2015-03-05"]]],
+     "options": {"providers": ["local", "csv", "web"], "retries": 3, ...}}
+
+and the daemon answers a line per lookup as soon as it is priced, then
+a last line with the batch's measurements (see pricestats.RunStats.export):
+
+    {"index": 1, "prices": {"2015-03-04": 107.9}, "pending": []}
+    {"done": true, "stats": {"latencies": {...}, "cache_hits": 1, ...}}
+
+A daemon started with other options than the client's answers an error,
+and the client fetches in-process.'''
+
+# Standard libraries
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from SocketServer import StreamRequestHandler, ThreadingMixIn, TCPServer
+
+# Custom modules
+import httppool
+import pricer
+import pricestats
+import quotecache
+import scheduler
+
+
+ADDRESS = os.environ.get('PRICED_ADDRESS', '')
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+TIMEOUT = float(os.environ.get('PRICED_TIMEOUT', 300))
+CONNECT_TIMEOUT = 1.0
+RETRY_AFTER = 60
+
+
+class Unavailable(IOError):
+    """The daemon can't be reached, or stopped answering."""
+
+
+def parse_address(address):
+    '''Return (family, address) for HOST:PORT or a Unix socket path.'''
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+
+def parse_date(date):
+    return quotecache.parse_iso_date(date)
+
+
+class Client(object):
+    """Send batched lookups to the daemon.
+
+    usage:
+        client = Client('127.0.0.1:8765')
+        for index, prices, pending in client.lookup([(symbol, dates), ...],
+                                                    pricer.lookup_options(),
+                                                    stats, chain):
+            ...
+
+    Answers arrive in the order lookups are priced, not the order asked.
+    Dates left pending because the daemon's breakers opened come back with
+    each answer. The daemon's measurements of the batch are added to stats,
+    and its provider counts to chain, at the end.
+    Unavailable is raised if the daemon can't be reached or drops out."""
+    def __init__(self, address=ADDRESS, timeout=TIMEOUT):
+        self.family, self.address = parse_address(address)
+        self.timeout = timeout
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(self.address)
+        except socket.error as e:
+            sock.close()
+            raise Unavailable(str(e))
+        sock.settimeout(self.timeout)
+        return sock
+
+    def ping(self):
+        '''Return True if the daemon accepts connections.'''
+        try:
+            self._connect().close()
+        except Unavailable:
+            return False
+        return True
+
+    def lookup(self, lookups, options=None, stats=None, chain=None):
+        '''Yield (index, {date: price}, pending dates) per (symbol, dates).'''
+        request = {'lookups': [(symbol, [dt.isoformat() for dt in dates])
+                               for symbol, dates in lookups],
+                   'options': options}
+        sock = self._connect()
+        try:
+            stream = sock.makefile('rwb')
+            stream.write(json.dumps(request) + '\n')
+            stream.flush()
+            while True:
+                line = stream.readline()
+                if not line:
+                    raise Unavailable('daemon closed the connection')
+                answer = json.loads(line)
+                if answer.get('done'):
+                    batch = answer.get('stats') or {}
+                    if stats is not None:
+                        stats.absorb(batch)
+                    if chain is not None:
+                        chain.absorb(batch.get('providers', {}))
+                    return
+                if 'error' in answer:
+                    raise Unavailable(answer['error'])
+                prices = dict((parse_date(date), price)
+                              for date, price in answer['prices'].iteritems())
+                pending = [parse_date(date) for date in answer['pending']]
+                yield answer['index'], prices, pending
+        except (socket.error, ValueError, KeyError) as e:
+            raise Unavailable(str(e))
+        finally:
+            sock.close()
+
+
+_client = None
+_retry_at = 0
+_client_lock = threading.Lock()
+
+
+def connect():
+    '''Return a Client if the daemon is running, otherwise None.
+
+    A daemon that didn't answer is not tried again for RETRY_AFTER
+    seconds. An empty PRICED_ADDRESS turns the daemon off.'''
+    global _client, _retry_at
+    with _client_lock:
+        if not ADDRESS:
+            return None
+        if _client is None and time.time() >= _retry_at:
+            client = Client(ADDRESS)
+            if client.ping():
+                _client = client
+            else:
+                _retry_at = time.time() + RETRY_AFTER
+        return _client
+
+
+def disconnect():
+    '''Stop using the daemon until it answers a ping again.'''
+    global _client, _retry_at
+    with _client_lock:
+        _client = None
+        _retry_at = time.time() + RETRY_AFTER
+
+
+class LookupHandler(StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                lookups = [(symbol, [parse_date(date) for date in dates])
+                           for symbol, dates in request['lookups']]
+            except (ValueError, KeyError, TypeError) as e:
+                self.send({'error': 'bad request: {0}'.format(e)})
+                continue
+
+            differ = self.server.differ(request.get('options'))
+            if differ:
+                self.send({'error': 'daemon prices with other {0}'.format(
+                    ', '.join(differ))})
+                continue
+
+            batch = pricestats.RunStats()
+
+            def lookup(index):
+                with pricestats.recording(batch):
+                    return (index,) + pricer.lookup_quote_range(*lookups[index])
+
+            self.server.begin()
+            try:
+                for index, prices, pending in self.server.pool.imap_unordered(
+                        lookup, range(len(lookups))):
+                    self.send({'index': index,
+                               'prices': dict((dt.isoformat(), price)
+                                              for dt, price in prices.iteritems()),
+                               'pending': [dt.isoformat() for dt in pending]})
+            finally:
+                self.server.end()
+            self.send({'done': True, 'stats': batch.export()})
+
+    def send(self, answer):
+        self.wfile.write(json.dumps(answer) + '\n')
+        self.wfile.flush()
+
+
+class PriceDaemon(ThreadingMixIn, TCPServer):
+    """Answer lookups from many clients on one shared pool of workers.
+
+    Hosts whose breaker opened get a fresh chance when a batch starts and
+    no other batch is in flight, since the daemon outlives the run that
+    tripped it. Each batch is measured on its own, see pricestats.recording."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workers=None):
+        workers = pricer.WORKERS if workers is None else workers
+        self.address_family, address = parse_address(address)
+        if self.address_family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        TCPServer.__init__(self, address, LookupHandler)
+        self.pool = ThreadPool(max(1, workers))
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def differ(self, options):
+        '''Return the names of client options that differ from the daemon's.
+
+        A request without options is priced with the daemon's own.'''
+        if options is None:
+            return []
+        own = pricer.lookup_options()
+        return sorted(name for name in set(own) | set(options)
+                      if own.get(name) != options.get(name))
+
+    def begin(self):
+        '''Start a batch, closing open breakers if no other batch is running.'''
+        with self._lock:
+            if not self.active:
+                sched = scheduler.get_scheduler()
+                if sched.tripped():
+                    sched.reset()
+            self.active += 1
+
+    def end(self):
+        with self._lock:
+            self.active -= 1
+
+    def server_close(self):
+        TCPServer.server_close(self)
+        self.pool.close()
+        if self.address_family == socket.AF_UNIX and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def main(args):
+    httppool.configure(args.connections, args.timeout)
+    pricer.configure_providers(args.providers)
+    scheduler.configure(args.retries, args.rate)
+
+    server = PriceDaemon(args.address, args.workers)
+    print 'Serving prices on', args.address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pricer.get_chain().report()
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-a', '--address', default=ADDRESS or DEFAULT_ADDRESS,
+                        help='HOST:PORT or Unix socket path to listen on')
+    parser.add_argument('-w', '--workers', type=int, default=pricer.WORKERS,
+                        help='number of symbols to price at once')
+    parser.add_argument('-t', '--timeout', type=float, default=httppool.TIMEOUT,
+                        help='seconds to wait on the quote server')
+    parser.add_argument('-c', '--connections', type=int,
+                        default=httppool.MAX_CONNECTIONS,
+                        help='most connections open to the quote server')
+    parser.add_argument('-r', '--retries', type=int, default=scheduler.RETRIES,
+                        help='times to retry a failed request')
+    parser.add_argument('-l', '--rate', type=float, default=scheduler.RATE,
+                        help='most requests per second to the quote server')
+    parser.add_argument('-o', '--providers', default=pricer.PROVIDERS,
+                        help='comma separated price sources to try, in order')
+
+    main(parser.parse_args())
@@ -2,11 +2,27 @@
 
 import argparse
 import datetime
+import errno
+import json
 import os
+import re
 import sys
-import urllib
+import threading
+import time
+import urlparse
 
+from collections import OrderedDict
 from HTMLParser import HTMLParser
+from multiprocessing.pool import ThreadPool
+
+import httppool
+import priced
+import pricestats
+import providers
+import quarantine
+import quotecache
+import scheduler
+import tradingcal
 
 
 URL_FORMAT = '%m%%2F%d%%2F%Y'
@@ -16,6 +32,16 @@ SYMBOL_FILE = os.environ.get('SYMBOL_FILE',
                              os.path.join('..', 'symbols.txt'))
 DOWNLOAD_DIR = os.environ.get('PRICE_DD',
                               os.path.join('..', 'supplemental-prices'))
+WORKERS = int(os.environ.get('PRICE_WORKERS', 8))
+CARRY_FORWARD = bool(os.environ.get('PRICE_CARRY_FORWARD'))
+LOOKBACK = int(os.environ.get('PRICE_LOOKBACK', 10))
+CHECKPOINT = 'daily.ckpt'
+MERGE_POLICIES = ['newest', 'keep']
+MERGE_POLICY = os.environ.get('PRICE_MERGE', 'newest')
+LOCK_STALE = 30
+PROVIDERS = os.environ.get('PRICE_PROVIDERS', 'local,csv,web')
+STATS_DIR = os.environ.get('PRICE_STATS_DIR', '')
+BASE_URL = os.environ.get('PRICE_URL', 'http://bigcharts.marketwatch.com/historical/default.asp?symb={symbol}&closeDate={url_date}&')
 
 
 tiaa_cref_dd = os.environ.get('TIAA_CREF_DD', os.getcwd())
@@ -27,6 +53,21 @@ csvfiles = {'cref3': os.path.join(tiaa_cref_dd, 'cref3.csv'),
             'crefilb': os.path.join(tiaa_cref_dd, 'crefilb.csv'), 
             'crefsoci': os.path.join(tiaa_cref_dd, 'crefsoci.csv'), 
             'crefstok': os.path.join(tiaa_cref_dd, 'crefstok.csv')} 
+CLOSING_PRICE_RE = re.compile(r'<th[^>]*>\s*Closing Price:\s*</th>\s*'
+                              r'<td[^>]*>\s*([^<]*?)\s*</td>', re.IGNORECASE)
+CHUNK_SIZE = 8192
+OVERLAP = 512
+csv_indexes = {}
+csv_indexes_lock = threading.Lock()
+print_lock = threading.Lock()
+
+
+def say(line):
+    '''Print line from a pool thread without running into other lines.
+
+    A bare print writes the text and the newline separately.'''
+    with print_lock:
+        print line
 
 
 class PriceParser(HTMLParser):
@@ -50,42 +91,330 @@ class PriceParser(HTMLParser):
             self.closing_price_found = False
 
 
-def get_quote(symbol, dt=None):
-    dt = datetime.date.today() if dt is None else dt
+def extract_closing_price(response, chunk_size=CHUNK_SIZE):
+    '''Scan a page for its closing price, reading only as far as needed.
+
+    Returns (price, content), where content is everything read so far and
+    price is None if the whole page was read without a recognizable match.
+    Stopping early saves scanning the rest of the page, not downloading
+    it: the connection pool reads it off to reuse the connection.'''
+    content = ''
+    while True:
+        chunk = response.read(chunk_size)
+        start = max(0, len(content) - OVERLAP)
+        content += chunk
+        match = CLOSING_PRICE_RE.search(content, start)
+        if match:
+            data = ''.join(match.group(1).split(','))
+            try:
+                return float(data), content
+            except ValueError:
+                return 0.0, content
+        if not chunk:
+            return None, content
+
+
+def read_closing_price(url):
+    '''Request a quote page and scan it, see extract_closing_price.
+
+    The wait for the server's answer and the time spent reading the page
+    are recorded in the run's stats.'''
+    stats = pricestats.get_stats()
+    host = urlparse.urlsplit(url).netloc
+    start = time.time()
+    try:
+        with httppool.urlopen(url) as response:
+            answered = time.time()
+            if response.status in scheduler.RETRY_STATUSES:
+                raise scheduler.ServerError(response.status)
+            price, content = extract_closing_price(response)
+            finished = time.time()
+    except scheduler.RETRYABLE:
+        stats.request(host, time.time() - start, ok=False)
+        raise
+
+    stats.request(host, answered - start, len(content), response.drained)
+    stats.parsed(finished - answered)
+    return price, content
+
+
+def get_web_price(symbol, dt):
+    '''Download the closing price of symbol on dt from bigcharts.
+
+    Raises scheduler.RequestFailed if every retry failed, and
+    scheduler.CircuitOpen if the server is failing and no longer asked.'''
     url_date = dt.strftime(URL_FORMAT)
-    csv_date = dt.strftime(DATE_FORMAT)
-    base_url = 'http://bigcharts.marketwatch.com/historical/default.asp?symb={symbol}&closeDate={url_date}&'
-    verbose = '{price_date} price for {symbol:8} = {parser.price:8.02f}'
-    content = urllib.urlopen(base_url.format(**locals())).read()
-
-    # instantiate the parser and feed it some HTML
-    parser = PriceParser()
-    parser.feed(content)
     price_date = dt.strftime(DATE_FORMAT)
-    print verbose.format(**locals())
-
-    # If price doesn't download look for it in local CSV files
-    if parser.price < 0:
-        csvfile = csvfiles.get(symbol.lower(), None)
-        if csvfile is None:
-            return parser.price
-        print 'Checking', csvfile
-        with open(csvfile, 'r') as data:
-            for line in data:
-                date, price, _ = line.split(',')            
-                if date == csv_date:
-                    parser.price = float(price[1:])
-                    print verbose.format(**locals())
-                    break
-
-    return parser.price
-
-
-def get_quotes(symbols, dt):
-    quotes = []
+    verbose = '{price_date} price for {symbol:8} = {price:8.02f}'
+    url = BASE_URL.format(**locals())
+    host = urlparse.urlsplit(url).netloc
+    price, content = scheduler.get_scheduler().call(host, read_closing_price, url)
+
+    # Unfamiliar page layouts go through the full HTML parser
+    if price is None:
+        start = time.time()
+        parser = PriceParser()
+        parser.feed(content)
+        price = parser.price
+        pricestats.get_stats().parsed(time.time() - start, fallback=True)
+    say(verbose.format(**locals()))
+
+    return price
+
+
+def try_web_price(symbol, dt):
+    '''Like get_web_price, but -1 after a failure and None once the circuit opens.
+
+    The price is counted for or against symbol in the quarantine.'''
+    try:
+        price = get_web_price(symbol, dt)
+    except scheduler.RequestFailed as e:
+        say('{0} price for {1:8} failed: {2}'.format(dt.strftime(DATE_FORMAT),
+                                                     symbol, e))
+        return -1
+    except scheduler.CircuitOpen:
+        return None
+
+    if quarantine.record(symbol, dt, price) == 'quarantined':
+        say('Quarantining {0} for {1:g} days'.format(symbol, quarantine.get_quarantine().ttl))
+    return price
+
+
+def load_csv_index(csvfile):
+    '''Return a {MM/DD/YYYY: price} index of a CREF CSV file.
+
+    Each file is parsed once per process, and again only if it changes.'''
+    mtime = os.path.getmtime(csvfile)
+    with csv_indexes_lock:
+        if csvfile in csv_indexes and csv_indexes[csvfile][0] == mtime:
+            return csv_indexes[csvfile][1]
+
+    say('Loading ' + csvfile)
+    index = {}
+    with open(csvfile, 'r') as data:
+        for line in data:
+            try:
+                csv_date, price, _ = line.split(',')
+                price = float(price[1:])
+            except ValueError:
+                continue
+            # The first price listed for a date wins
+            index.setdefault(csv_date, price)
+
+    with csv_indexes_lock:
+        csv_indexes[csvfile] = (mtime, index)
+
+    return index
+
+
+def get_csv_prices(symbol, dates):
+    '''Look up closing prices of symbol for dates in local CSV files.
+
+    Returns a {date: price} dict of the dates found.'''
+    prices = {}
+    csvfile = csvfiles.get(symbol.lower(), None)
+    if csvfile is None or not os.path.exists(csvfile):
+        return prices
+
+    index = load_csv_index(csvfile)
+    verbose = '{csv_date} price for {symbol:8} = {price:8.02f}'
+    for dt in dates:
+        csv_date = dt.strftime(DATE_FORMAT)
+        price = index.get(csv_date)
+        if price is not None:
+            prices[dt] = price
+            say(verbose.format(**locals()))
+
+    return prices
+
+
+class CrefCsvProvider(providers.Provider):
+    """Prices from the TIAA-CREF cref*.csv history files."""
+    name = 'csv'
+
+    def lookup(self, symbol, dates):
+        return get_csv_prices(symbol, dates)
+
+
+class WebProvider(providers.Provider):
+    """Prices downloaded from bigcharts, one page per date.
 
-    for symbol in symbols:
-        price = get_quote(symbol, dt)
+    Quarantined symbols are not requested. The quarantine is checked once
+    per lookup, so failures on the first dates of a range, say before the
+    symbol's history starts, don't skip the later dates that have prices."""
+    name = 'web'
+
+    def lookup(self, symbol, dates):
+        prices = {}
+        if quarantine.state(symbol) is not None:
+            return prices
+        for dt in dates:
+            price = try_web_price(symbol, dt)
+            if price is None or price >= 0:
+                prices[dt] = price
+
+        return prices
+
+
+PROVIDER_TYPES = {'local': providers.LocalPriceProvider,
+                  'csv': CrefCsvProvider,
+                  'web': WebProvider}
+_chain = None
+_chain_lock = threading.Lock()
+
+
+def get_chain():
+    '''Return the shared chain of price providers.'''
+    global _chain
+    with _chain_lock:
+        if _chain is None:
+            _chain = configure_providers()
+        return _chain
+
+
+def configure_providers(names=None):
+    '''Replace the shared chain with comma separated provider names, in order.'''
+    global _chain
+    names = PROVIDERS if names is None else names
+    _chain = providers.ProviderChain([PROVIDER_TYPES[name.strip()]()
+                                      for name in names.split(',')])
+    return _chain
+
+
+def lookup_options():
+    '''Return the settings that decide how this process prices a lookup.
+
+    The price daemon only answers clients whose options match its own.'''
+    sched = scheduler.get_scheduler()
+    return {'providers': [provider.name for provider in get_chain().providers],
+            'url': BASE_URL,
+            'retries': sched.retries,
+            'rate': sched.rate,
+            'threshold': sched.threshold,
+            'timeout': httppool.get_pool().timeout}
+
+
+def get_quote(symbol, dt=None):
+    dt = datetime.date.today() if dt is None else dt
+    return get_quote_range(symbol, [dt]).get(dt, -1)
+
+
+def get_quote_range(symbol, dates):
+    '''Return a {date: price} dict of closing prices of symbol on dates.
+
+    Dates nobody priced are left out, see lookup_quote_range.'''
+    return quote_ranges([symbol], dates)[0]
+
+
+def lookup_quote_range(symbol, dates):
+    '''Price symbol on dates in this process, return (prices, pending).
+
+    Cached prices are read in one query, then each provider of the chain
+    is asked in turn for the dates still missing. Dates nobody priced are
+    left out of the {date: price} dict, and listed as pending if some
+    provider could not be reached for them.'''
+    if not dates:
+        return {}, []
+    if quarantine.state(symbol) == 'pinned':
+        say('Skipping pinned symbol ' + symbol)
+        return {}, []
+
+    # Closing prices never change, so reuse ones from earlier downloads
+    prices = {}
+    cached = quotecache.lookup_range(symbol, dates[0], dates[-1])
+    for dt in dates:
+        if dt in cached:
+            price, source = cached[dt]
+            prices[dt] = price
+            csv_date = dt.strftime(DATE_FORMAT)
+            say('{csv_date} price for {symbol:8} = {price:8.02f} ({source})'.format(**locals()))
+
+    missing = [dt for dt in dates if dt not in prices]
+    pricestats.get_stats().cache(hits=len(prices), misses=len(missing))
+    found, pending = get_chain().prices(symbol, missing)
+    for dt, (price, source) in found.iteritems():
+        prices[dt] = price
+        if price > 0:
+            quotecache.store(symbol, dt, price, source)
+
+    return prices, pending
+
+
+def settle_range(symbol, dates, prices, pending):
+    '''Count a looked up range in the run's stats and pending work.'''
+    stats = pricestats.get_stats()
+    for dt in pending:
+        scheduler.get_scheduler().add_pending(symbol, dt)
+    unpriced = sum(1 for dt in dates if prices.get(dt, -1) <= 0)
+    if unpriced:
+        stats.failed(symbol, unpriced)
+    stats.done(len(dates))
+    return prices
+
+
+def quote_ranges(symbols, dates, workers=None):
+    '''Return a {date: price} dict per symbol, in the order of symbols.
+
+    Every symbol is priced on the same dates, see quote_lookups.'''
+    dates = sorted(dates)
+    return quote_lookups([(symbol, dates) for symbol in symbols], workers)
+
+
+def quote_lookups(lookups, workers=None):
+    '''Return a {date: price} dict per (symbol, dates) lookup, in order.
+
+    The lookups go to the price daemon in one batch when it is running
+    with the same options, see lookup_options. Otherwise, or for whatever
+    the daemon left unanswered, they are made here on a thread pool, see
+    map_symbols.'''
+    lookups = [(symbol, sorted(dates)) for symbol, dates in lookups]
+    ranges = [None] * len(lookups)
+
+    client = priced.connect()
+    if client is not None and lookups:
+        try:
+            for index, prices, pending in client.lookup(lookups, lookup_options(),
+                                                        pricestats.get_stats(),
+                                                        get_chain()):
+                symbol, dates = lookups[index]
+                ranges[index] = settle_range(symbol, dates, prices, pending)
+        except priced.Unavailable as e:
+            print 'Price daemon failed, fetching here:', e
+            priced.disconnect()
+
+    def fetch(index):
+        symbol, dates = lookups[index]
+        prices, pending = lookup_quote_range(symbol, dates)
+        return settle_range(symbol, dates, prices, pending)
+
+    left = [index for index, prices in enumerate(ranges) if prices is None]
+    for index, prices in zip(left, map_symbols(fetch, left, workers)):
+        ranges[index] = prices
+
+    return ranges
+
+
+def map_symbols(func, symbols, workers=None):
+    '''Return [func(symbol) for symbol in symbols], run on a thread pool.
+
+    Up to `workers` symbols are handled at once (WORKERS by default), a
+    value of 1 handles them one after another.'''
+    workers = WORKERS if workers is None else workers
+    if workers <= 1 or len(symbols) <= 1:
+        return [func(symbol) for symbol in symbols]
+
+    pool = ThreadPool(min(workers, len(symbols)))
+    try:
+        return pool.map(func, symbols)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def build_quotes(symbols, prices):
+    '''Pair symbols with their prices, skipping failures.'''
+    quotes = []
+    for symbol, price in zip(symbols, prices):
         if price >= 0:
             quotes.append((symbol, price))
             if symbol.lower() == 'agg':
@@ -94,6 +423,17 @@ def get_quotes(symbols, dt):
     return quotes
 
 
+def get_quotes(symbols, dt, workers=None):
+    '''Download prices for many symbols, keeping the order of symbols.
+
+    Up to `workers` symbols are fetched at once, see quote_ranges.'''
+    symbols = list(symbols)
+    pricestats.get_stats().expect(len(symbols))
+    ranges = quote_ranges(symbols, [dt], workers)
+
+    return build_quotes(symbols, [prices.get(dt, -1) for prices in ranges])
+
+
 def read_symbol_file(symbol_file='symbols.txt'):
     symbols = []
 
@@ -103,26 +443,153 @@ def read_symbol_file(symbol_file='symbols.txt'):
                 symbol = symbol.strip()
                 if symbol.startswith('#'):
                     symbol = ''
-                if symbols != '':
+                if symbol != '':
                     symbols.append(symbol)
 
     return symbols
 
 
-def write_quotes_file(quotes, filename, date_str):
-    """Build a fixed width quotes file from a collection of symbols and prices."""
+def price_filename(download_dir, dt):
+    '''Return the path of the fi{MMDDYY}.pri file for dt.'''
+    return os.path.join(download_dir, 'fi{0}.pri'.format(dt.strftime(PC_FORMAT)))
+
+
+def read_quotes_file(filename):
+    '''Return a {SYMBOL: line} dict of a fixed width quotes file.
+
+    Symbols are upper cased and kept in file order, and later lines win
+    over earlier ones.'''
+    entries = OrderedDict()
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                fields = line.split()
+                if fields:
+                    entries[fields[0].upper()] = line
+
+    return entries
+
+
+def line_price(line):
+    '''Return the price of a quotes file line, or None if it has none.'''
+    # Symbol, then the price running into the MMDDYY date
+    fields = line[:-6].split()
+    try:
+        return float(fields[-1]) if len(fields) > 1 else None
+    except ValueError:
+        return None
+
+
+def replace_file(src, dst):
+    '''Rename src over dst, even where rename won't overwrite.'''
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+class FileLock(object):
+    """Hold filename.lock while filename is read, merged and replaced.
+
+    usage:
+        with FileLock(filename):
+            ...
+
+    The lock file is created exclusively, which works on Windows too. A
+    lock older than LOCK_STALE seconds was left by a process that died,
+    and is taken over."""
+    def __init__(self, filename):
+        self.path = filename + '.lock'
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time() - os.path.getmtime(self.path) > LOCK_STALE:
+                    os.remove(self.path)
+                    continue
+            except OSError:
+                # Released while we looked
+                continue
+            time.sleep(0.01)
+
+    def __exit__(self, *exc):
+        os.remove(self.path)
+
+
+def write_quotes_file(quotes, filename, date_str, policy=None):
+    """Merge a collection of symbols and prices into a fixed width quotes file.
+
+    Symbols already in the file keep their line under the 'keep' policy, and
+    are replaced under 'newest' (MERGE_POLICY by default). Under either, a
+    price of 0.00, from a failed parse or an "n/a" page, never replaces a
+    positive price already in the file. The merged file
+    is written aside and renamed into place, so reruns never duplicate.
+    A FileLock keeps processes writing the same file at once from dropping
+    each other's quotes."""
     if not quotes:
         return
+    policy = MERGE_POLICY if policy is None else policy
 
-    # Create and write quote entries
+    # Merge quote entries into those already written
     fixed = '{symbol:9}{price:>64.02f}{date_str}'
-    entries = [fixed.format(**locals()) for symbol, price in quotes]
-    with open(filename, 'a') as out:
-        out.write('\n'.join(entries) + '\n')
-
-
-def download_date(symbols, dt, download_dir, log=False):
-    quotes = get_quotes(symbols, dt)
+    with FileLock(filename):
+        entries = read_quotes_file(filename)
+        for symbol, price in quotes:
+            old = entries.get(symbol.upper())
+            if old is not None and (policy == 'keep' or
+                                    price <= 0 < line_price(old)):
+                continue
+            entries[symbol.upper()] = fixed.format(**locals())
+
+        temp = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(temp, 'w') as out:
+            out.write('\n'.join(entries.itervalues()) + '\n')
+        replace_file(temp, filename)
+
+
+def pricing_date(dt, carry_forward=None):
+    '''Return the date whose closing prices belong in the price file of dt.
+
+    That is dt itself on trading days. On other days it is the previous
+    close when carrying prices forward, and None when not.'''
+    carry_forward = CARRY_FORWARD if carry_forward is None else carry_forward
+    if tradingcal.is_trading_day(dt):
+        return dt
+    if carry_forward:
+        return tradingcal.previous_trading_day(dt)
+    return None
+
+
+def start_run():
+    '''Close breakers an earlier run opened and forget its pending prices.
+
+    Long-lived callers, like the GUI, price many runs in one process.'''
+    scheduler.get_scheduler().reset()
+
+
+def download_date(symbols, dt, download_dir, log=False, workers=None,
+                  carry_forward=None, report=True):
+    '''Download prices for symbols into the price file of dt.
+
+    Unless `report` is False, this is a run of its own: it starts with
+    fresh breakers, and is reported when done, see finish_run. Otherwise
+    it is one step of a bigger run.'''
+    if report:
+        start_run()
+    price_dt = pricing_date(dt, carry_forward)
+    if price_dt is None:
+        print 'Market closed on', dt.strftime(DATE_FORMAT)
+        return
+    start = time.time()
+    quotes = get_quotes(symbols, price_dt, workers)
     date_str = dt.strftime(PC_FORMAT)
 
     # Get output filename
@@ -130,14 +597,167 @@ def download_date(symbols, dt, download_dir, log=False):
         print 'Download directory does not exist.'
         return
 
-    name = 'fi{date_str}.pri'.format(**locals())
-    filename = os.path.join(download_dir, name)
+    filename = price_filename(download_dir, dt)
     print 'File: ' + filename
 
     write_quotes_file(quotes, filename, date_str)
+    pricestats.get_stats().date_done(dt, time.time() - start)
     if log:
         with open(os.path.join(download_dir, 'date.log'), 'a') as f:
             f.write(str(datetime.date.today()) + '\n')
+    if report:
+        finish_run()
+
+
+def download_range(symbols, dates, download_dir, workers=None,
+                   carry_forward=None):
+    '''Download prices for every symbol on every date, symbol by symbol.
+
+    The whole (symbol, date) matrix is fetched per symbol across the range,
+    then scattered into one fi{MMDDYY}.pri file per date.'''
+    if not os.path.exists(download_dir):
+        print 'Download directory does not exist.'
+        return
+
+    start_run()
+    symbols = list(symbols)
+    price_dates = dict((dt, pricing_date(dt, carry_forward)) for dt in dates)
+    fetch_dates = sorted(set(price_dates.itervalues()) - set([None]))
+    print 'Planning {0} symbols x {1} dates'.format(len(symbols), len(fetch_dates))
+    stats = pricestats.get_stats()
+    stats.expect(len(symbols) * len(fetch_dates))
+    start = time.time()
+    ranges = quote_ranges(symbols, fetch_dates, workers)
+    # Dates are fetched together, so each gets an even share of the wait
+    share = (time.time() - start) / max(1, len(fetch_dates))
+
+    for dt in dates:
+        price_dt = price_dates[dt]
+        if price_dt is None:
+            print 'Market closed on', dt.strftime(DATE_FORMAT)
+            continue
+        start = time.time()
+        prices = [symbol_prices.get(price_dt, -1) for symbol_prices in ranges]
+        quotes = build_quotes(symbols, prices)
+        date_str = dt.strftime(PC_FORMAT)
+        filename = price_filename(download_dir, dt)
+        print 'File: ' + filename
+
+        write_quotes_file(quotes, filename, date_str)
+        stats.date_done(dt, share + time.time() - start)
+
+
+def recent_dates(lookback=LOOKBACK, carry_forward=None, today=None):
+    '''Return the last `lookback` dates that get a price file, oldest first.'''
+    carry_forward = CARRY_FORWARD if carry_forward is None else carry_forward
+    dt = datetime.date.today() if today is None else today
+    dates = []
+    while len(dates) < max(1, lookback):
+        if tradingcal.is_trading_day(dt) or (carry_forward and dt.weekday() < 5):
+            dates.append(dt)
+        dt -= datetime.timedelta(1)
+
+    return dates[::-1]
+
+
+def find_gaps(symbols, dates, download_dir):
+    '''Return [(date, symbols)] pairs for symbols missing from price files.'''
+    gaps = []
+    for dt in dates:
+        entries = read_quotes_file(price_filename(download_dir, dt))
+        missing = [symbol for symbol in symbols if symbol.upper() not in entries]
+        if missing:
+            gaps.append((dt, missing))
+
+    return gaps
+
+
+def load_checkpoint(checkpoint):
+    '''Return the gaps left in today's checkpoint, or None.'''
+    if not os.path.exists(checkpoint):
+        return None
+    with open(checkpoint, 'r') as f:
+        state = json.load(f)
+    if state['created'] != datetime.date.today().isoformat():
+        return None
+
+    return [(quotecache.parse_iso_date(date), symbols)
+            for date, symbols in state['gaps']]
+
+
+def save_checkpoint(checkpoint, gaps):
+    '''Save the gaps still to fill, replacing the checkpoint in one step.'''
+    state = {'created': datetime.date.today().isoformat(),
+             'gaps': [(dt.isoformat(), symbols) for dt, symbols in gaps]}
+    with open(checkpoint + '.tmp', 'w') as f:
+        json.dump(state, f)
+    replace_file(checkpoint + '.tmp', checkpoint)
+
+
+def download_gaps(symbols, download_dir, lookback=LOOKBACK, workers=None,
+                  carry_forward=None):
+    '''Fetch prices missing from the files of the last `lookback` dates.
+
+    Existing fi{MMDDYY}.pri files are scanned for (date, symbol) pairs
+    they lack, and only those are downloaded. The plan is kept in a
+    checkpoint file, so a run that dies picks up where it stopped.'''
+    if not os.path.exists(download_dir):
+        print 'Download directory does not exist.'
+        return
+
+    start_run()
+    checkpoint = os.path.join(download_dir, CHECKPOINT)
+    gaps = load_checkpoint(checkpoint)
+    if gaps is None:
+        dates = recent_dates(lookback, carry_forward)
+        gaps = find_gaps(symbols, dates, download_dir)
+        save_checkpoint(checkpoint, gaps)
+    else:
+        print 'Resuming from', checkpoint
+    missing = sum(len(gap_symbols) for dt, gap_symbols in gaps)
+    print 'Filling {0} missing prices on {1} dates'.format(missing, len(gaps))
+
+    while gaps:
+        dt, gap_symbols = gaps[0]
+        download_date(gap_symbols, dt, download_dir, workers=workers,
+                      carry_forward=carry_forward, report=False)
+        gaps.pop(0)
+        save_checkpoint(checkpoint, gaps)
+    os.remove(checkpoint)
+
+
+def report_pending():
+    '''Print the prices left undone by an open circuit, return their count.
+
+    The circuit may have opened here or in the price daemon.'''
+    sched = scheduler.get_scheduler()
+    if not sched.pending:
+        return 0
+
+    pending = sorted(sched.pending, key=lambda pair: (pair[1], pair[0]))
+    print 'Quote server kept failing, stopped with {0} prices pending:'.format(len(pending))
+    for symbol, dt in pending:
+        print '\t', dt.strftime(DATE_FORMAT), symbol
+
+    return len(pending)
+
+
+def finish_run():
+    '''Report on the run, and save its stats in STATS_DIR when it is set.
+
+    Runs that priced nothing save no stats. Stats and provider counts start
+    over afterwards, and the number of prices left pending by an open
+    circuit is returned.'''
+    chain = get_chain()
+    chain.report()
+    stats = pricestats.get_stats()
+    if STATS_DIR and stats.quoted:
+        if not os.path.isdir(STATS_DIR):
+            os.makedirs(STATS_DIR)
+        print 'Stats: ' + stats.write(STATS_DIR)
+    pricestats.reset()
+    chain.reset()
+    return report_pending()
 
 
 def from_quick_date(quick_date):
@@ -152,15 +772,26 @@ def from_quick_date(quick_date):
     return datetime.date(year, month, day)
 
 
-def daterange(start_date, end_date=None):
+def daterange(start_date, end_date=None, trading_only=False):
     if end_date is None:
         end_date = start_date + datetime.timedelta(1)
 
     for n in range(int((end_date - start_date).days)):
-        yield start_date + datetime.timedelta(n)
+        dt = start_date + datetime.timedelta(n)
+        if trading_only and not tradingcal.is_trading_day(dt):
+            continue
+        yield dt
 
 
 def main(args):
+    global MERGE_POLICY, STATS_DIR
+    MERGE_POLICY = args.merge
+    STATS_DIR = args.stats_dir
+    httppool.configure(args.connections, args.timeout)
+    configure_providers(args.providers)
+    scheduler.configure(args.retries, args.rate)
+    pricestats.reset(args.progress)
+
     # Get date or date range
     if args.start_date is not None and args.end_date is not None:
         # Download a range
@@ -209,11 +840,30 @@ def main(args):
         download_dir = args.download_dir
     download_dir = download_dir or DOWNLOAD_DIR
 
-    for dt in daterange(start_date, end_date):
-        if dt.weekday() >= 5:
-            continue
-        download_date(symbols, dt, download_dir, log=args.daily)
-
+    # The daily download fills whatever is missing from recent files
+    if args.daily and args.date is None and args.start_date is None:
+        download_gaps(symbols, download_dir, args.lookback, args.workers,
+                      args.carry_forward)
+        if os.path.exists(download_dir):
+            with open(os.path.join(download_dir, 'date.log'), 'a') as f:
+                f.write(str(datetime.date.today()) + '\n')
+        return -1002 if finish_run() else 0
+
+    # Holidays get a file only when carrying the previous close forward
+    if args.carry_forward:
+        dates = [dt for dt in daterange(start_date, end_date) if dt.weekday() < 5]
+    else:
+        dates = list(daterange(start_date, end_date, trading_only=True))
+    if len(dates) > 1:
+        download_range(symbols, dates, download_dir, workers=args.workers,
+                       carry_forward=args.carry_forward)
+    elif dates:
+        download_date(symbols, dates[0], download_dir, log=args.daily,
+                      workers=args.workers, carry_forward=args.carry_forward,
+                      report=False)
+
+    if finish_run():
+        return -1002
     return 0
 
 
@@ -233,5 +883,32 @@ if __name__ == '__main__':
                         help='file containing a list of symbols (absolute)')
     parser.add_argument('-p', '--download-dir', default=DOWNLOAD_DIR,
                         help='path to download location (absolute)')
-
-    main(parser.parse_args())
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+                        help='number of symbols to download at once')
+    parser.add_argument('-t', '--timeout', type=float, default=httppool.TIMEOUT,
+                        help='seconds to wait on the quote server')
+    parser.add_argument('-c', '--connections', type=int,
+                        default=httppool.MAX_CONNECTIONS,
+                        help='most connections open to the quote server')
+    parser.add_argument('-r', '--retries', type=int, default=scheduler.RETRIES,
+                        help='times to retry a failed request')
+    parser.add_argument('-l', '--rate', type=float, default=scheduler.RATE,
+                        help='most requests per second to the quote server')
+    parser.add_argument('-k', '--carry-forward', action='store_true',
+                        default=CARRY_FORWARD,
+                        help='write the previous close on market holidays')
+    parser.add_argument('-b', '--lookback', type=int, default=LOOKBACK,
+                        help='trading days the daily download checks for gaps')
+    parser.add_argument('-m', '--merge', choices=MERGE_POLICIES,
+                        default=MERGE_POLICY,
+                        help='which price wins for symbols already in a file')
+    parser.add_argument('-o', '--providers', default=PROVIDERS,
+                        help='comma separated price sources to try, in order '
+                             '(local, csv, web)')
+    parser.add_argument('-g', '--progress', action='store_true',
+                        default=pricestats.PROGRESS,
+                        help='show a live progress line on stderr')
+    parser.add_argument('--stats-dir', default=STATS_DIR,
+                        help='directory to save each run\'s stats JSON in')
+
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+'''Measurements of a price download run.
+
+pricer records every request, parse, cache lookup and failure here, and
+writes a summary as JSON to PRICE_STATS_DIR, if set, when the run
+finishes. With progress turned on, a status line is kept up to date on
+stderr.'''
+
+# Standard libraries
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def percentile(values, fraction):
+    '''Return the value below which `fraction` of sorted values fall.'''
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class RunStats(object):
+    """Counters and timings of one run, safe to update from many threads.
+
+    usage:
+        stats = RunStats()
+        stats.request('bigcharts.marketwatch.com', 0.21, 61000)
+        stats.cache(misses=1)
+        stats.write(download_dir)"""
+    def __init__(self, progress=False):
+        self.started = time.time()
+        self.progress = progress
+        self.total = 0
+        self.quoted = 0
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.scanned_bytes = 0
+        self.drained_bytes = 0
+        self.parses = 0
+        self.fallbacks = 0
+        self.parse_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.failures = defaultdict(int)
+        self.dates = {}
+        self.providers = {}
+        self._lock = threading.Lock()
+
+    def request(self, host, seconds, nbytes=0, drained=0, ok=True):
+        '''Record one HTTP request and how long the server took to answer.
+
+        nbytes counts the part of the page scanned for its price, drained
+        the rest, read off only to reuse the connection.'''
+        with self._lock:
+            if ok:
+                self.latencies[host].append(seconds)
+                self.scanned_bytes += nbytes
+                self.drained_bytes += drained
+            else:
+                self.errors[host] += 1
+
+    def parsed(self, seconds, fallback=False):
+        '''Record the time spent reading and scanning one page.
+
+        A fallback is a second pass over a page the scan didn't recognize.'''
+        with self._lock:
+            if fallback:
+                self.fallbacks += 1
+            else:
+                self.parses += 1
+            self.parse_seconds += seconds
+
+    def cache(self, hits=0, misses=0):
+        with self._lock:
+            self.cache_hits += hits
+            self.cache_misses += misses
+
+    def provided(self, name, asked, hits, seconds):
+        '''Record a lookup a price provider answered.'''
+        with self._lock:
+            counts = self.providers.setdefault(name, {'asked': 0, 'hits': 0,
+                                                      'seconds': 0.0})
+            counts['asked'] += asked
+            counts['hits'] += hits
+            counts['seconds'] += seconds
+
+    def failed(self, symbol, count=1):
+        '''Record dates a symbol could not be priced on.'''
+        with self._lock:
+            self.failures[symbol.upper()] += count
+
+    def date_done(self, dt, seconds):
+        with self._lock:
+            self.dates[dt.isoformat()] = round(self.dates.get(dt.isoformat(), 0) +
+                                               seconds, 3)
+
+    def expect(self, count):
+        '''Add count quotes to the total shown in the progress line.'''
+        with self._lock:
+            self.total += count
+
+    def done(self, count=1):
+        '''Mark count quotes as finished, and refresh the progress line.'''
+        with self._lock:
+            self.quoted += count
+            if not self.progress:
+                return
+            elapsed = max(time.time() - self.started, 1e-6)
+            errors = sum(self.errors.itervalues())
+            line = '\r{0}/{1} quotes  {2:.1f}/s  {3} errors '.format(
+                self.quoted, self.total or '?', self.quoted / elapsed, errors)
+            sys.stderr.write(line)
+            sys.stderr.flush()
+
+    def export(self):
+        '''Return the raw request, parse and cache measurements as a dict.'''
+        with self._lock:
+            return {'latencies': dict(self.latencies),
+                    'errors': dict(self.errors),
+                    'scanned_bytes': self.scanned_bytes,
+                    'drained_bytes': self.drained_bytes,
+                    'parses': self.parses,
+                    'fallbacks': self.fallbacks,
+                    'parse_seconds': self.parse_seconds,
+                    'cache_hits': self.cache_hits,
+                    'cache_misses': self.cache_misses,
+                    'providers': dict((name, dict(counts))
+                                      for name, counts in self.providers.iteritems())}
+
+    def absorb(self, data):
+        '''Add measurements another process exported, see export.'''
+        with self._lock:
+            for host, latencies in data.get('latencies', {}).iteritems():
+                self.latencies[host].extend(latencies)
+            for host, errors in data.get('errors', {}).iteritems():
+                self.errors[host] += errors
+            self.scanned_bytes += data.get('scanned_bytes', 0)
+            self.drained_bytes += data.get('drained_bytes', 0)
+            self.parses += data.get('parses', 0)
+            self.fallbacks += data.get('fallbacks', 0)
+            self.parse_seconds += data.get('parse_seconds', 0.0)
+            self.cache_hits += data.get('cache_hits', 0)
+            self.cache_misses += data.get('cache_misses', 0)
+        for name, counts in data.get('providers', {}).iteritems():
+            self.provided(name, counts['asked'], counts['hits'], counts['seconds'])
+
+    def summary(self):
+        '''Return the run's measurements as a dict.'''
+        with self._lock:
+            hosts = {}
+            for host, latencies in self.latencies.iteritems():
+                latencies = sorted(latencies)
+                hosts[host] = {'requests': len(latencies),
+                               'errors': self.errors.get(host, 0),
+                               'p50_ms': round(1000 * percentile(latencies, 0.5), 1),
+                               'p90_ms': round(1000 * percentile(latencies, 0.9), 1),
+                               'p99_ms': round(1000 * percentile(latencies, 0.99), 1)}
+            for host, errors in self.errors.iteritems():
+                if host not in hosts:
+                    hosts[host] = {'requests': 0, 'errors': errors}
+            lookups = self.cache_hits + self.cache_misses
+
+            return {'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+                    'wall_seconds': round(time.time() - self.started, 3),
+                    'quotes': self.quoted,
+                    'requests': sum(len(l) for l in self.latencies.itervalues()),
+                    'hosts': hosts,
+                    'scanned_bytes': self.scanned_bytes,
+                    'drained_bytes': self.drained_bytes,
+                    'parses': self.parses,
+                    'parse_fallbacks': self.fallbacks,
+                    'parse_ms': round(1000 * self.parse_seconds / self.parses, 2)
+                                if self.parses else 0.0,
+                    'cache': {'hits': self.cache_hits,
+                              'misses': self.cache_misses,
+                              'hit_rate': round(float(self.cache_hits) / lookups, 3)
+                                          if lookups else 0.0},
+                    'providers': dict((name, {'asked': counts['asked'],
+                                              'hits': counts['hits'],
+                                              'seconds': round(counts['seconds'], 3)})
+                                      for name, counts in self.providers.iteritems()),
+                    'failures': dict(self.failures),
+                    'dates': dict(self.dates)}
+
+    def write(self, directory):
+        '''Save the summary as stats-YYYYMMDD-HHMMSS.json in directory.'''
+        if self.progress:
+            sys.stderr.write('\n')
+        stamp = datetime.datetime.fromtimestamp(self.started).strftime('%Y%m%d-%H%M%S')
+        filename = os.path.join(directory, 'stats-{0}.json'.format(stamp))
+        count = 1
+        while os.path.exists(filename):
+            filename = os.path.join(directory, 'stats-{0}-{1}.json'.format(stamp, count))
+            count += 1
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+        return filename
+
+
+_stats = None
+_stats_lock = threading.Lock()
+_local = threading.local()
+PROGRESS = bool(os.environ.get('PRICE_PROGRESS'))
+
+
+def get_stats():
+    '''Return the stats of the current run, or of this thread's batch.'''
+    global _stats
+    batch = getattr(_local, 'stats', None)
+    if batch is not None:
+        return batch
+    with _stats_lock:
+        if _stats is None:
+            _stats = RunStats(PROGRESS)
+        return _stats
+
+
+def reset(progress=None):
+    '''Start a new run, return its stats.'''
+    global _stats, PROGRESS
+    with _stats_lock:
+        if progress is not None:
+            PROGRESS = progress
+        _stats = RunStats(PROGRESS)
+        return _stats
+
+
+@contextmanager
+def recording(stats):
+    '''Record this thread's measurements in stats instead of the run's.
+
+    The price daemon keeps one RunStats per batch this way, and sends it
+    back to the client that asked.'''
+    _local.stats = stats
+    try:
+        yield stats
+    finally:
+        _local.stats = None
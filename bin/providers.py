@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+'''Sources of closing prices, asked in order until one has the price.
+
+A provider answers lookup(symbol, dates) with a {date: price} dict of the
+prices it has, and keeps count of how often it was asked, how often it
+had a price and how long it took.'''
+
+# Standard libraries
+import os
+import threading
+import time
+
+# Custom modules
+import pricestats
+
+
+LOCAL_DIR = os.environ.get('PRICE_LOCAL_DIR',
+                           os.environ.get('TIAA_CREF_DD', os.getcwd()))
+PC_FORMAT = '%m%d%y'
+
+
+class Provider(object):
+    """Base class of price sources.
+
+    Subclasses set `name` and implement lookup(symbol, dates), returning
+    prices for the dates they know. A date mapped to None means the source
+    could not be reached for it."""
+    name = None
+
+    def __init__(self):
+        self.asked = 0
+        self.hits = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def lookup(self, symbol, dates):
+        raise NotImplementedError
+
+    def prices(self, symbol, dates):
+        '''Time and count a lookup.'''
+        start = time.time()
+        prices = self.lookup(symbol, dates)
+        elapsed = time.time() - start
+        hits = sum(1 for price in prices.itervalues()
+                   if price is not None and price > 0)
+        self.add(len(dates), hits, elapsed)
+        pricestats.get_stats().provided(self.name, len(dates), hits, elapsed)
+        return prices
+
+    def add(self, asked, hits, seconds):
+        with self._lock:
+            self.asked += asked
+            self.hits += hits
+            self.seconds += seconds
+
+    def reset(self):
+        '''Start counting from zero again.'''
+        with self._lock:
+            self.asked = 0
+            self.hits = 0
+            self.seconds = 0.0
+
+    def report(self):
+        '''Return a line with this provider's hit rate and latency.'''
+        rate = 100.0 * self.hits / self.asked if self.asked else 0.0
+        latency = 1000.0 * self.seconds / self.asked if self.asked else 0.0
+        return '{0:8}{1:>8}{2:>8}{3:>8.1f}%{4:>10.2f} ms'.format(
+            self.name, self.asked, self.hits, rate, latency)
+
+
+class LocalPriceProvider(Provider):
+    """Prices already written to fi{MMDDYY}.pri files on disk.
+
+    fidoconvert writes the TIAA-CREF prices this way. Each file is read
+    once, and again only when it changes."""
+    name = 'local'
+
+    def __init__(self, directory=LOCAL_DIR):
+        Provider.__init__(self)
+        self.directory = directory
+        self._files = {}
+
+    def load(self, filename):
+        '''Return a {SYMBOL: price} dict of a price file.'''
+        if not os.path.exists(filename):
+            return {}
+        mtime = os.path.getmtime(filename)
+        with self._lock:
+            if filename in self._files and self._files[filename][0] == mtime:
+                return self._files[filename][1]
+
+        prices = {}
+        with open(filename, 'r') as f:
+            for line in f:
+                # Symbol, then the price running into the MMDDYY date
+                fields = line.rstrip('\r\n')[:-6].split()
+                if len(fields) < 2:
+                    continue
+                try:
+                    prices[fields[0].upper()] = float(fields[-1])
+                except ValueError:
+                    continue
+
+        with self._lock:
+            self._files[filename] = (mtime, prices)
+        return prices
+
+    def lookup(self, symbol, dates):
+        prices = {}
+        for dt in dates:
+            filename = os.path.join(self.directory,
+                                    'fi{0}.pri'.format(dt.strftime(PC_FORMAT)))
+            price = self.load(filename).get(symbol.upper())
+            if price is not None:
+                prices[dt] = price
+
+        return prices
+
+
+class ProviderChain(object):
+    """Ask providers in order for the prices the earlier ones lacked.
+
+    usage:
+        chain = ProviderChain([LocalPriceProvider(), ...])
+        found, pending = chain.prices('SPY', dates)
+
+    found maps dates to (price, provider name), and pending lists dates
+    that no provider priced and some provider could not reach."""
+    def __init__(self, providers):
+        self.providers = providers
+
+    def prices(self, symbol, dates):
+        found = {}
+        unreached = set()
+        remaining = list(dates)
+        for provider in self.providers:
+            if not remaining:
+                break
+            for dt, price in provider.prices(symbol, remaining).iteritems():
+                if price is None:
+                    unreached.add(dt)
+                elif price > 0 or dt not in found:
+                    found[dt] = (price, provider.name)
+            # A zero price is kept only until a better one turns up
+            remaining = [dt for dt in remaining
+                         if dt not in found or found[dt][0] <= 0]
+
+        pending = sorted(dt for dt in unreached if dt not in found)
+        return found, pending
+
+    def absorb(self, counts):
+        '''Add the provider counts a price daemon sent, see pricestats.'''
+        for provider in self.providers:
+            if provider.name in counts:
+                provider.add(counts[provider.name]['asked'],
+                             counts[provider.name]['hits'],
+                             counts[provider.name]['seconds'])
+
+    def reset(self):
+        '''Start counting every provider from zero again.'''
+        for provider in self.providers:
+            provider.reset()
+
+    def report(self):
+        '''Print the hit rate and latency of each provider.'''
+        print '{0:8}{1:>8}{2:>8}{3:>9}{4:>13}'.format('source', 'asked', 'hits',
+                                                    'rate', 'latency')
+        for provider in self.providers:
+            print provider.report()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+'''Quarantine symbols that repeatedly fail to price.
+
+Every date a symbol comes back without a price, or with a price of zero,
+is counted against it. After THRESHOLD failures in a row the symbol is
+quarantined for TTL days, and pricer stops requesting it from the web
+until then. Pinned symbols are never priced at all, for symbols whose
+historical prices are known to be wrong.
+
+Run this module to list, release or pin entries.'''
+
+# Standard libraries
+import argparse
+import datetime
+import os
+import threading
+
+# Custom modules
+import quotecache
+
+
+THRESHOLD = int(os.environ.get('PRICE_QUARANTINE_AFTER', 5))
+TTL = float(os.environ.get('PRICE_QUARANTINE_DAYS', 7))
+
+# Symbols that find erroneous historical prices, pinned when the table is created
+LEGACY_PINS = ['1402', '1926', '1933', '1934', 'FRCMQ', 'KBS']
+
+SCHEMA = '''CREATE TABLE quarantine (
+    symbol TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL,
+    first TEXT,
+    last TEXT,
+    until TEXT,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    reason TEXT)'''
+
+
+class Quarantine(object):
+    """Failure counts and quarantines per symbol, stored in SQLite.
+
+    usage:
+        quarantine = Quarantine('quotes.db')
+        quarantine.failure('DEAD', datetime.date(2015, 3, 4), 'no price')
+        quarantine.state('DEAD') in (None, 'quarantined', 'pinned')
+        quarantine.success('DEAD')     # clears the count
+
+    Shares a database with quotecache.QuoteCache."""
+    def __init__(self, filename=quotecache.CACHE_FILE, threshold=THRESHOLD,
+                 ttl=TTL, timeout=30):
+        self.filename = filename
+        self.threshold = threshold
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = quotecache.connect(self.filename, self.timeout)
+            conn.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'quarantine'").fetchone()
+            if not exists:
+                conn.execute(SCHEMA)
+                for symbol in LEGACY_PINS:
+                    conn.execute('INSERT INTO quarantine (symbol, failures, pinned, reason) '
+                                 'VALUES (?, 0, 1, ?)',
+                                 (symbol, 'erroneous historical prices'))
+            conn.execute('COMMIT')
+            self._local.conn = conn
+        return conn
+
+    def state(self, symbol):
+        '''Return 'pinned', 'quarantined' or None for symbol.'''
+        row = self._connection().execute(
+            'SELECT pinned, until FROM quarantine WHERE symbol = ?',
+            (symbol.upper(),)).fetchone()
+        if row is None:
+            return None
+        pinned, until = row
+        if pinned:
+            return 'pinned'
+        if until and until > datetime.datetime.now().isoformat():
+            return 'quarantined'
+        return None
+
+    def failure(self, symbol, dt, reason):
+        '''Count a failure to price symbol on dt, return the symbol's state.'''
+        symbol = symbol.upper()
+        day = dt.isoformat()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT failures, first, last, until, pinned '
+                               'FROM quarantine WHERE symbol = ?',
+                               (symbol,)).fetchone()
+            failures, first, last, until, pinned = row or (0, day, day, None, 0)
+            failures += 1
+            first = min(first or day, day)
+            last = max(last or day, day)
+            if failures >= self.threshold and not pinned:
+                until = (datetime.datetime.now() +
+                         datetime.timedelta(self.ttl)).isoformat()
+            conn.execute('INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (symbol, failures, first, last, until, pinned, reason))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+        return self.state(symbol)
+
+    def success(self, symbol):
+        '''Forget the failures of a symbol that priced, unless it is pinned.'''
+        self._connection().execute(
+            'DELETE FROM quarantine WHERE symbol = ? AND pinned = 0',
+            (symbol.upper(),))
+
+    def release(self, symbol):
+        '''Remove symbol from quarantine, pinned or not.'''
+        return self._connection().execute(
+            'DELETE FROM quarantine WHERE symbol = ?',
+            (symbol.upper(),)).rowcount
+
+    def pin(self, symbol, reason):
+        '''Never price symbol again, until released.'''
+        self._connection().execute(
+            'INSERT OR REPLACE INTO quarantine (symbol, failures, pinned, reason) '
+            'VALUES (?, 0, 1, ?)', (symbol.upper(), reason))
+
+    def entries(self):
+        '''List (symbol, failures, first, last, until, pinned, reason) rows.'''
+        return self._connection().execute(
+            'SELECT * FROM quarantine ORDER BY symbol').fetchall()
+
+
+_quarantine = None
+_quarantine_lock = threading.Lock()
+
+
+def get_quarantine():
+    '''Return the shared quarantine, or None when PRICE_CACHE is empty.'''
+    global _quarantine
+    with _quarantine_lock:
+        if _quarantine is None and quotecache.CACHE_FILE:
+            _quarantine = Quarantine(quotecache.CACHE_FILE)
+        return _quarantine
+
+
+def state(symbol):
+    '''Return 'pinned', 'quarantined' or None from the shared quarantine.
+
+    Without a database, as when PRICE_CACHE is empty, LEGACY_PINS are
+    still pinned.'''
+    quarantine = get_quarantine()
+    if quarantine is None:
+        return 'pinned' if symbol.upper() in LEGACY_PINS else None
+    return quarantine.state(symbol)
+
+
+def record(symbol, dt, price):
+    '''Count a web price for or against symbol in the shared quarantine.
+
+    Returns the symbol's state after a failure, otherwise None.'''
+    quarantine = get_quarantine()
+    if quarantine is None:
+        return None
+    if price > 0:
+        quarantine.success(symbol)
+        return None
+    reason = 'zero price' if price == 0 else 'no price'
+    return quarantine.failure(symbol, dt, reason)
+
+
+def main(args):
+    quarantine = Quarantine(args.cache)
+
+    if args.release:
+        for symbol in args.release.split(','):
+            count = quarantine.release(symbol)
+            print 'Released', symbol if count else symbol + ' (not found)'
+    if args.pin:
+        for symbol in args.pin.split(','):
+            quarantine.pin(symbol, args.reason)
+            print 'Pinned', symbol
+
+    if not args.release and not args.pin:
+        line = '{0:9}{1:>9}  {2:11}{3:11}{4:12}{5}'
+        print line.format('symbol', 'failures', 'first', 'last', 'state', 'reason')
+        for symbol, failures, first, last, until, pinned, reason in quarantine.entries():
+            status = quarantine.state(symbol) or ''
+            print line.format(symbol, failures, first or '', last or '',
+                              status, reason or '')
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--release',
+                        help='comma separated list of symbols to release')
+    parser.add_argument('-p', '--pin',
+                        help='comma separated list of symbols to never price')
+    parser.add_argument('--reason', default='pinned by hand',
+                        help='why the pinned symbols are skipped')
+    parser.add_argument('--cache', default=quotecache.CACHE_FILE or 'quotes.db',
+                        help='path to the price cache database')
+
+    main(parser.parse_args())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+'''Persistent cache of closing prices, keyed by (symbol, date).
+
+Prices are kept in a SQLite database along with where they came from,
+so reruns of pricer and batcher don't download them again. Several
+processes may share one database.'''
+
+# Standard libraries
+import argparse
+import datetime
+import os
+import sqlite3
+import threading
+
+
+CACHE_FILE = os.environ.get('PRICE_CACHE', os.path.join('..', 'quotes.db'))
+QUICK_FORMAT = '%m%d%y'
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS quotes (
+    symbol TEXT NOT NULL,
+    date TEXT NOT NULL,
+    price REAL NOT NULL,
+    source TEXT NOT NULL,
+    fetched TEXT NOT NULL,
+    PRIMARY KEY (symbol, date))'''
+
+
+def parse_iso_date(date):
+    '''Return the date of a YYYY-MM-DD string.
+
+    Used instead of strptime, whose first call from a worker thread can
+    fail in Python 2 with "no attribute '_strptime'".'''
+    year, month, day = date.split('-')
+    return datetime.date(int(year), int(month), int(day))
+
+
+def connect(filename, timeout=30):
+    '''Open a SQLite database that several processes may share.'''
+    conn = sqlite3.connect(filename, timeout=timeout)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+class QuoteCache(object):
+    """Closing prices stored in a SQLite database.
+
+    usage:
+        cache = QuoteCache('quotes.db')
+        cache.put('SPY', datetime.date(2015, 3, 4), 210.6, 'web')
+        cache.get('SPY', datetime.date(2015, 3, 4)) == (210.6, 'web')
+
+    Each thread gets its own connection, and writers wait on each other
+    for up to `timeout` seconds."""
+    def __init__(self, filename=CACHE_FILE, timeout=30):
+        self.filename = filename
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.filename, self.timeout)
+            conn.execute(SCHEMA)
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _where(self, symbol=None, start=None, end=None):
+        clauses = []
+        params = []
+        if symbol is not None:
+            clauses.append('symbol = ?')
+            params.append(symbol.upper())
+        if start is not None:
+            clauses.append('date >= ?')
+            params.append(start.isoformat())
+        if end is not None:
+            clauses.append('date <= ?')
+            params.append(end.isoformat())
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, params
+
+    def get(self, symbol, dt):
+        '''Return (price, source) for symbol on dt, or None.'''
+        row = self._connection().execute(
+            'SELECT price, source FROM quotes WHERE symbol = ? AND date = ?',
+            (symbol.upper(), dt.isoformat())).fetchone()
+        return tuple(row) if row else None
+
+    def put(self, symbol, dt, price, source):
+        '''Store the price of symbol on dt.'''
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO quotes VALUES (?, ?, ?, ?, ?)',
+                         (symbol.upper(), dt.isoformat(), price, source,
+                          datetime.datetime.now().isoformat()))
+
+    def get_range(self, symbol, start, end):
+        '''Return a {date: (price, source)} dict for symbol from start to end.'''
+        where, params = self._where(symbol, start, end)
+        rows = self._connection().execute(
+            'SELECT date, price, source FROM quotes' + where, params)
+        return dict((parse_iso_date(date), (price, source))
+                    for date, price, source in rows)
+
+    def entries(self, symbol=None, start=None, end=None):
+        '''List (symbol, date, price, source, fetched) rows.'''
+        where, params = self._where(symbol, start, end)
+        return self._connection().execute(
+            'SELECT * FROM quotes' + where + ' ORDER BY symbol, date',
+            params).fetchall()
+
+    def invalidate(self, symbol=None, start=None, end=None):
+        '''Remove matching prices and return how many were removed.'''
+        where, params = self._where(symbol, start, end)
+        conn = self._connection()
+        with conn:
+            return conn.execute('DELETE FROM quotes' + where, params).rowcount
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    '''Return the shared cache, or None when PRICE_CACHE is empty.'''
+    global _cache
+    with _cache_lock:
+        if _cache is None and CACHE_FILE:
+            _cache = QuoteCache(CACHE_FILE)
+        return _cache
+
+
+def lookup(symbol, dt):
+    '''Return (price, source) from the shared cache, or None.'''
+    cache = get_cache()
+    return cache.get(symbol, dt) if cache else None
+
+
+def lookup_range(symbol, start, end):
+    '''Return a {date: (price, source)} dict from the shared cache.'''
+    cache = get_cache()
+    return cache.get_range(symbol, start, end) if cache else {}
+
+
+def store(symbol, dt, price, source):
+    '''Save a final closing price in the shared cache.
+
+    Only days before today are kept, since today's price may still move.'''
+    cache = get_cache()
+    if cache and dt < datetime.date.today():
+        cache.put(symbol, dt, price, source)
+
+
+def main(args):
+    cache = QuoteCache(args.cache)
+    start = end = None
+    if args.start_date:
+        start = datetime.datetime.strptime(args.start_date, QUICK_FORMAT).date()
+    if args.end_date:
+        end = datetime.datetime.strptime(args.end_date, QUICK_FORMAT).date()
+    symbols = args.symbols.split(',') if args.symbols else [None]
+
+    for symbol in symbols:
+        if args.invalidate:
+            count = cache.invalidate(symbol, start, end)
+            print 'Removed {0} prices for {1}'.format(count, symbol or 'all symbols')
+        else:
+            for row in cache.entries(symbol, start, end):
+                print '{0:9}{1:11}{2:>12.04f}  {3:10}{4}'.format(*row)
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--invalidate', action='store_true', default=False,
+                        help='remove matching prices instead of listing them')
+    parser.add_argument('-y', '--symbols',
+                        help='comma separated list of symbols to match')
+    parser.add_argument('-s', '--start-date',
+                        help='first date to match (MMDDYY)')
+    parser.add_argument('-e', '--end-date',
+                        help='last date to match (MMDDYY)')
+    parser.add_argument('--cache', default=CACHE_FILE or 'quotes.db',
+                        help='path to the price cache database')
+
+    main(parser.parse_args())
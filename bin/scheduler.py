@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+'''Retries, rate limits and circuit breakers for quote requests.
+
+Every request to a host waits for a token from that host's bucket, is
+retried with jittered exponential backoff when it fails, and stops being
+sent at all once the host has failed too many times in a row.'''
+
+# Standard libraries
+import httplib
+import os
+import random
+import threading
+import time
+
+
+RETRIES = int(os.environ.get('PRICE_RETRIES', 3))
+BACKOFF = float(os.environ.get('PRICE_BACKOFF', 0.5))
+MAX_BACKOFF = 30.0
+RATE = float(os.environ.get('PRICE_RATE', 10))
+THRESHOLD = int(os.environ.get('PRICE_BREAKER', 10))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ServerError(httplib.HTTPException):
+    """The server answered with a status worth retrying."""
+    def __init__(self, status):
+        httplib.HTTPException.__init__(self, 'HTTP status {0}'.format(status))
+        self.status = status
+
+
+class RequestFailed(Exception):
+    """A request still failed after every retry."""
+
+
+class CircuitOpen(Exception):
+    """The host failed too often, no more requests are sent to it."""
+
+
+RETRYABLE = (IOError, httplib.HTTPException)
+
+
+class TokenBucket(object):
+    """Allow `rate` calls per second on average, in bursts of up to `rate`."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        '''Wait for a token and use it.'''
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker(object):
+    """Open after `threshold` failures in a row, and stay open.
+
+    An open breaker ends a run early instead of hammering a failing host,
+    reset() closes it again."""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.failures = 0
+        self.open = False
+        self._lock = threading.Lock()
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                self.open = True
+
+    def reset(self):
+        with self._lock:
+            self.failures = 0
+            self.open = False
+
+
+class Scheduler(object):
+    """Send requests through per-host rate limits and breakers.
+
+    usage:
+        scheduler = Scheduler(retries=3, rate=5)
+        content = scheduler.call('bigcharts.marketwatch.com', fetch, url)
+
+    Work that could not be done because a breaker opened is collected in
+    `pending` as (symbol, date) pairs."""
+    def __init__(self, retries=RETRIES, backoff=BACKOFF, rate=RATE,
+                 threshold=THRESHOLD):
+        self.retries = retries
+        self.backoff = backoff
+        self.rate = rate
+        self.threshold = threshold
+        self.pending = []
+        self._buckets = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate)
+            return self._buckets[host]
+
+    def breaker(self, host):
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.threshold)
+            return self._breakers[host]
+
+    def delay(self, attempt):
+        '''Seconds to wait before retry number `attempt` (full jitter).'''
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def call(self, host, func, *args, **kwargs):
+        '''Return func(*args, **kwargs), retrying it when it fails.'''
+        breaker = self.breaker(host)
+        for attempt in range(self.retries + 1):
+            if breaker.open:
+                raise CircuitOpen(host)
+            if attempt:
+                time.sleep(self.delay(attempt - 1))
+            self.bucket(host).take()
+            try:
+                result = func(*args, **kwargs)
+            except RETRYABLE as e:
+                breaker.failure()
+                error = e
+                continue
+            breaker.success()
+            return result
+
+        if breaker.open:
+            raise CircuitOpen(host)
+        raise RequestFailed('{0}: {1}'.format(host, error))
+
+    def add_pending(self, symbol, dt):
+        with self._lock:
+            self.pending.append((symbol, dt))
+
+    def reset(self):
+        '''Close every breaker and forget pending work.'''
+        with self._lock:
+            for breaker in self._breakers.itervalues():
+                breaker.reset()
+            self.pending = []
+
+    def tripped(self):
+        '''Return True if any host's breaker is open.'''
+        with self._lock:
+            return any(breaker.open for breaker in self._breakers.itervalues())
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    '''Return the scheduler shared by every price download.'''
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+
+def configure(retries=None, rate=None, threshold=None):
+    '''Replace the shared scheduler with one using new limits.'''
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = Scheduler(RETRIES if retries is None else retries,
+                               BACKOFF,
+                               RATE if rate is None else rate,
+                               THRESHOLD if threshold is None else threshold)
+        return _scheduler
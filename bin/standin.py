@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+'''Local stand-in for the bigcharts historical quote server.
+
+Serves pages shaped like historical/default.asp with made up, repeatable
+prices, and can add latency and errors. Point pricer at it with
+PRICE_URL, for example:
+
+    python standin.py --port 8000 --latency 0.2 --error-rate 0.1
+    PRICE_URL='http://127.0.0.1:8000/historical/default.asp?symb={symbol}&closeDate={url_date}&' python pricer.py ...'''
+
+# Standard libraries
+import argparse
+import random
+import threading
+import time
+import urlparse
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+URL_FORMAT = 'http://{host}:{port}/historical/default.asp?symb={{symbol}}&closeDate={{url_date}}&'
+
+
+def synthetic_page(price=123.45, size=60000):
+    '''Build a page shaped like a bigcharts historical quote page.
+
+    A price of None leaves the closing price out, like an unknown symbol.'''
+    head = '<html><head><script>var x = 1;</script></head><body>\n'
+    filler = '<div class="ad"><a href="/x">{0}</a></div>\n'
+    quote = ''
+    if price is not None:
+        quote = ('<table class="historicalquote fatbottomed">\n'
+                 '<tr><th>Closing Price:</th><td>{0:,.2f}</td></tr>\n'
+                 '<tr><th>Open:</th><td>n/a</td></tr>\n'
+                 '</table>\n').format(price)
+    before = ''.join(filler.format(n) for n in range(size * 2 / 5 / 40))
+    after = ''.join(filler.format(n) for n in range(size * 3 / 5 / 40))
+    return head + before + quote + after + '</body></html>'
+
+
+def synthetic_price(symbol, close_date):
+    '''Return a repeatable made up price, or None for unknown symbols.'''
+    if symbol.upper().startswith('ZZ'):
+        return None
+    return 10 + zlib.crc32(symbol.upper() + close_date) % 100000 / 100.0
+
+
+class QuoteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+
+        if server.error_rate and random.random() < server.error_rate:
+            server.count('errors')
+            body = 'Service Unavailable'
+            self.send_response(503)
+        else:
+            query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+            symbol = query.get('symb', [''])[0]
+            close_date = query.get('closeDate', [''])[0]
+            if server.pages:
+                body = random.choice(server.pages)
+            else:
+                body = synthetic_page(synthetic_price(symbol, close_date),
+                                      server.page_size)
+            self.send_response(200)
+        server.count('bytes', len(body))
+
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    """Threaded stand-in server, with counters of what it served.
+
+    Recorded `pages` are served at random when given, otherwise pages are
+    made up from the requested symbol and date."""
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, page_size=60000,
+                 pages=None):
+        HTTPServer.__init__(self, address, QuoteHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.pages = pages or []
+        self.counters = {'requests': 0, 'errors': 0, 'bytes': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        '''pricer URL template for this server.'''
+        host, port = self.server_address
+        return URL_FORMAT.format(**locals())
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response are expected
+        pass
+
+
+def start(port=0, **kwargs):
+    '''Run a stand-in server on a background thread and return it.'''
+    server = StandinServer(('127.0.0.1', port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help='port to listen on')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='average seconds to wait before answering')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 503')
+    parser.add_argument('-s', '--page-size', type=int, default=60000,
+                        help='approximate bytes per page')
+    args = parser.parse_args()
+
+    server = StandinServer(('127.0.0.1', args.port), args.latency,
+                           args.error_rate, args.page_size)
+    print 'Serving', server.url
+    server.serve_forever()
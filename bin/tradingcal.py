@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+'''NYSE trading calendar, worked out offline from the exchange's rules.
+
+Weekends, the regular holidays and the special closings listed below are
+not trading days. An optional override file (TRADING_CALENDAR) lists
+extra dates, one per line, as "MM/DD/YYYY closed" or "MM/DD/YYYY open".
+
+Run this module to list the holidays of a year.'''
+
+# Standard libraries
+import _strptime  # strptime imports it lazily, which can fail in a thread
+import argparse
+import datetime
+import os
+import threading
+
+
+CALENDAR_FILE = os.environ.get('TRADING_CALENDAR', '')
+DATE_FORMAT = '%m/%d/%Y'
+
+# Unscheduled closings the holiday rules don't cover
+SPECIAL_CLOSINGS = [datetime.date(2001, 9, 11), datetime.date(2001, 9, 12),
+                    datetime.date(2001, 9, 13), datetime.date(2001, 9, 14),
+                    datetime.date(2004, 6, 11), datetime.date(2007, 1, 2),
+                    datetime.date(2012, 10, 29), datetime.date(2012, 10, 30),
+                    datetime.date(2018, 12, 5), datetime.date(2025, 1, 9)]
+
+MONDAY, THURSDAY = 0, 3
+
+_holidays = {}
+_overrides = None
+_lock = threading.Lock()
+
+
+def easter(year):
+    '''Return Easter Sunday of year (anonymous Gregorian algorithm).'''
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+def nth_weekday(year, month, weekday, n):
+    '''Return the nth weekday of a month, counting from the end if n < 0.'''
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta((weekday - first.weekday()) % 7 + 7 * (n - 1))
+    if month == 12:
+        last = datetime.date(year, 12, 31)
+    else:
+        last = datetime.date(year, month + 1, 1) - datetime.timedelta(1)
+    return last - datetime.timedelta((last.weekday() - weekday) % 7 + 7 * (-n - 1))
+
+
+def observed(dt):
+    '''Move a holiday on a weekend to the nearest weekday.'''
+    if dt.weekday() == 5:
+        return dt - datetime.timedelta(1)
+    if dt.weekday() == 6:
+        return dt + datetime.timedelta(1)
+    return dt
+
+
+def holidays(year):
+    '''Return the set of NYSE holidays in year.'''
+    with _lock:
+        if year in _holidays:
+            return _holidays[year]
+
+    days = set([nth_weekday(year, 2, MONDAY, 3),        # Washington's Birthday
+                easter(year) - datetime.timedelta(2),   # Good Friday
+                nth_weekday(year, 5, MONDAY, -1),       # Memorial Day
+                observed(datetime.date(year, 7, 4)),    # Independence Day
+                nth_weekday(year, 9, MONDAY, 1),        # Labor Day
+                nth_weekday(year, 11, THURSDAY, 4),     # Thanksgiving
+                observed(datetime.date(year, 12, 25))]) # Christmas
+
+    # New Year's Day on a Saturday is not made up on Friday
+    new_year = datetime.date(year, 1, 1)
+    if new_year.weekday() != 5:
+        days.add(observed(new_year))
+    if year >= 1998:
+        days.add(nth_weekday(year, 1, MONDAY, 3))      # Martin Luther King Day
+    if year >= 2022:
+        days.add(observed(datetime.date(year, 6, 19))) # Juneteenth
+    days.update(dt for dt in SPECIAL_CLOSINGS if dt.year == year)
+
+    with _lock:
+        _holidays[year] = days
+    return days
+
+
+def load_overrides(calendar_file=None):
+    '''Return a {date: is_open} dict from an override file.
+
+    Blank lines and # comments are skipped, lines that can't be read are
+    skipped with a warning.'''
+    calendar_file = CALENDAR_FILE if calendar_file is None else calendar_file
+    overrides = {}
+    if calendar_file and os.path.exists(calendar_file):
+        with open(calendar_file, 'r') as f:
+            for number, line in enumerate(f, 1):
+                line = line.split('#')[0].strip()
+                if not line:
+                    continue
+                try:
+                    date, status = line.split()
+                    dt = datetime.datetime.strptime(date, DATE_FORMAT).date()
+                    if status.lower() not in ('open', 'closed'):
+                        raise ValueError('status is not open or closed')
+                except ValueError as e:
+                    print 'Skipping line {0} of {1}: {2}'.format(number, calendar_file, e)
+                    continue
+                overrides[dt] = status.lower() == 'open'
+
+    return overrides
+
+
+def is_trading_day(dt):
+    '''Return True if the market is open on dt.'''
+    global _overrides
+    if _overrides is None:
+        _overrides = load_overrides()
+    if dt in _overrides:
+        return _overrides[dt]
+    return dt.weekday() < 5 and dt not in holidays(dt.year)
+
+
+def previous_trading_day(dt):
+    '''Return the last trading day before dt.'''
+    dt -= datetime.timedelta(1)
+    while not is_trading_day(dt):
+        dt -= datetime.timedelta(1)
+    return dt
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('year', type=int, nargs='?',
+                        default=datetime.date.today().year,
+                        help='year to list holidays for')
+    args = parser.parse_args()
+
+    for dt in sorted(holidays(args.year)):
+        if not is_trading_day(dt):
+            print dt.strftime(DATE_FORMAT + ' %A')